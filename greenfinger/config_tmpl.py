@@ -2,27 +2,119 @@
 Configuration template
 """
 
+# Hold this pin low (FLASH button) during SAFE_BOOT_WINDOW ms after power-on,
+# or create a 'safeboot' file, to stop main.py from starting greenfinger.
+SAFE_BOOT_PIN = const(0)
+SAFE_BOOT_WINDOW = const(1500)
+
 MQTT_CLIENT_ID = "greenfinger1"
 MQTT_SERVER = ("IP.ADDRESS", 1883)
 MQTT_USER = None
 MQTT_PASS = None
+# Queue up to this many messages while the broker is away instead of
+# blocking the loop on reconnects; 0 keeps the old blocking behaviour.
+MQTT_QUEUE_SIZE = const(16)
+# Keep only the newest queued message per topic instead of dropping the oldest
+MQTT_QUEUE_COALESCE = True
+# Give up a queued-mode reconnect (TCP connect, then CONNACK) after this
+# many seconds each, so an unreachable broker stalls the loop only briefly.
+# MQTT_SERVER should be an IP: a DNS lookup can't be bounded.
+MQTT_CONNECT_TIMEOUT = const(1)
+# Ping the broker after MQTT_KEEPALIVE/2 quiet seconds and drop the
+# connection if it doesn't answer within MQTT_PING_TIMEOUT seconds, so a
+# dead link (e.g. after a router reboot) is noticed in seconds and not
+# when a publish times out; 0 disables.
+MQTT_KEEPALIVE = const(20)
+MQTT_PING_TIMEOUT = const(5)
+# Publish all readings of a cycle as one JSON document on a shared state
+# topic, with the entities' own topics below HA_NODE_ID too, so several
+# nodes can share a broker; None gives each entity its own state topic.
+# Changing it leaves the old retained configs on the broker to clear.
+HA_NODE_ID = "greenfinger1"
+# Publish a reading only if it moved by more than its deadband, at most
+# every HA_MIN_INTERVAL seconds but at least every HA_HEARTBEAT seconds.
+HA_MIN_INTERVAL = const(30)
+HA_HEARTBEAT = const(15 * 60)
+HA_DEADBAND_AIR_TEMP = 0.5
+HA_DEADBAND_AIR_HUMID = 2
+HA_DEADBAND_MOISTURE = 1.0
 
 DISPLAY_SCL = const(13)
 DISPLAY_SDA = const(4)
+# Seconds without a visible change before dimming / blanking; None disables
+DISPLAY_DIM_AFTER = 10 * 60
+DISPLAY_OFF_AFTER = None
 
 DHT_PIN = const(2)
 DHT_OFFSET_TEMP = const(-3)
 DHT_OFFSET_HUMID = const(0)
 
-HUM_SENSOR_A = const(16)
-HUM_SENSOR_B = const(5)
-PUMP_A = const(14)
-PUMP_B = const(12)
+# Plants: (id, probe, pump pin, target moisture %, water seconds[, pump mA]).
+# probe is the GPIO powering a probe read on A0, or a channel of a probe
+# bank: ("mux", channel) or ("ads", channel).
+ENTITIES = (
+    ("a", 16, 14, 5, 5),
+    ("b", 5, 12, 5, 5),
+)
+# Probe banks: all their probes are excited by PROBE_POWER and read in one
+# pass. PROBE_MUX_SELECT are the S0.. pins of a CD4051 (3) or CD4067 (4)
+# in front of A0; PROBE_ADS1115 the I2C address of an ADS1115 on the
+# display's bus.
+PROBE_POWER = None
+PROBE_MUX_SELECT = None
+PROBE_ADS1115 = None
+
+# Pumps: at most PUMP_MAX_RUNNING at once, drawing at most PUMP_BUDGET mA
+# together (None: no limit), PUMP_CURRENT mA each unless the entity says
+# otherwise. Watering runs in pulses of at most PUMP_PULSE seconds (None:
+# all at once) with PUMP_SOAK seconds in between; the driest plant first.
+# Each pump must fit PUMP_BUDGET on its own; more than one pump at a time
+# needs a supply that can feed them together.
+PUMP_MAX_RUNNING = const(1)
+PUMP_BUDGET = None
+PUMP_CURRENT = const(250)
+PUMP_PULSE = None
+PUMP_SOAK = const(60)
+
+# Adaptive sampling: each probe is read every SAMPLE_MIN..SAMPLE_MAX
+# seconds, the longest once moisture is SAMPLE_MARGIN % above its target,
+# and SAMPLE_LEAD times before the drying trend reaches the target.
+# Sampled every cycle for SAMPLE_BOOST seconds after watering. A triage
+# window whose readings already put it clearly above or below the target
+# takes no more of them.
+# SAMPLE_MAX = None reads every probe every cycle.
+SAMPLE_MIN = const(10)
+SAMPLE_MAX = const(30 * 60)
+SAMPLE_MARGIN = 10
+SAMPLE_LEAD = const(4)
+SAMPLE_BOOST = const(30 * 60)
+
+# Log triages and waterings to flash, in a ring of LOG_SEGMENTS files of
+# LOG_SEGMENT_RECORDS 12-byte records, written LOG_BUFFER records at a
+# time (those are lost on a power cut). Publish "start end" to
+# greenfinger/<MQTT_CLIENT_ID>/log/query to get them back. None disables.
+LOG_SEGMENTS = const(8)
+LOG_SEGMENT_RECORDS = const(512)
+LOG_BUFFER = const(16)
+
+# Publish heap statistics (free heap, largest block up to 4 KB, heap
+# growth per loop phase) and the readings each probe rejected as outliers
+# as diagnostic sensors every DIAG_PERIOD seconds, on a separate
+# state topic when HA_NODE_ID is set; None disables
+DIAG_PERIOD = const(15 * 60)
+
+# Low power: None stays awake. "light" or "deep" measures and publishes
+# in one burst, then sleeps until the next sample or triage is due, for
+# POWER_MIN_SLEEP..POWER_MAX_SLEEP seconds. State survives deep sleep in
+# the RTC memory, which holds up to 6 entities. MQTT disconnects for the sleep, which outlasts
+# MQTT_KEEPALIVE. Deep sleep needs GPIO16 wired to RST, so move probe
+# "a" off pin 16 first.
+POWER_MODE = None
+POWER_MIN_SLEEP = const(60)
+POWER_MAX_SLEEP = const(10 * 60)
 
-TARGET_MOISTURE_A = const(5)
-TARGET_MOISTURE_B = const(5)
-WATER_TIME_A = const(5)
-WATER_TIME_B = const(5)
+# Run measuring, triage, pumps, display and MQTT as separate uasyncio tasks
+ASYNC_RUNTIME = False
 
 WIFI_NAME = "NAME"
 WIFI_PASS = "PASS"
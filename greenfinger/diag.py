@@ -0,0 +1,160 @@
+"""
+Heap instrumentation.
+
+Keeps the last samples of free heap, the largest allocatable block and
+the heap growth over each phase of the main loop in fixed ring buffers,
+and publishes their min/max/trend as Home Assistant diagnostic sensors,
+along with the readings each entity rejected as outliers.
+Apart from probing the largest block, sampling allocates nothing.
+
+Heap growth is the net change of gc.mem_alloc(): what a phase allocated
+and still holds at its end. Garbage it dropped again isn't counted, and
+a collection inside the phase leaves no usable figure (skipped).
+"""
+import gc
+from array import array
+try:
+    import utime as time
+except ImportError:
+    import time
+
+import discovery
+import ha_api
+
+
+class Ring:
+    "Last `size` integer samples"
+    def __init__(self, size):
+        self.data = array("i", bytes(4 * size))
+        self.pos = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def put(self, value):
+        self.data[self.pos] = value
+        self.pos = (self.pos + 1) % len(self.data)
+        if self.count < len(self.data):
+            self.count += 1
+
+    def _at(self, i):
+        "i-th oldest sample"
+        return self.data[(self.pos - self.count + i) % len(self.data)]
+
+    def min(self):
+        return min(self._at(i) for i in range(self.count)) if self.count else 0
+
+    def max(self):
+        return max(self._at(i) for i in range(self.count)) if self.count else 0
+
+    def slope(self, x):
+        "Least squares change per unit of x, a Ring filled alongside"
+        n = self.count
+        if n < 2:
+            return 0
+        # From the first x on, or single precision floats lose timestamps
+        x0 = x._at(0)
+        mean_x = sum(x._at(i) - x0 for i in range(n)) / n
+        mean_y = sum(self._at(i) for i in range(n)) / n
+        num = 0
+        den = 0
+        for i in range(n):
+            dx = x._at(i) - x0 - mean_x
+            num += dx * (self._at(i) - mean_y)
+            den += dx * dx
+        return num / den if den else 0
+
+
+def largest_block(free, limit, step):
+    """
+    Largest block up to limit bytes that can be allocated now, to step
+    bytes. Sizes are tried from the top down, so at most one block (garbage
+    until the next collection) is allocated, and limit keeps it small.
+    """
+    size = min(free, limit) // step * step
+    while size > 0:
+        try:
+            bytearray(size)
+            return size
+        except MemoryError:
+            size -= step
+    return 0
+
+
+class Diag:
+    # Loop phases, indices into growth
+    MEASURE = 0
+    TRIAGE = 1
+    DISPLAY = 2
+    PUBLISH = 3
+    PHASES = ("measure", "triage", "display", "publish")
+
+    SIZE = 64
+    # Probing the largest block may cost a few collections; not every sample
+    LARGEST_EVERY = 6
+    # Blocks this large are plenty for the firmware; the probe stops there
+    LARGEST_LIMIT = 4096
+    LARGEST_STEP = 512
+
+    def __init__(self, mqtt, node_id=None, period=15 * 60, entities=()):
+        self.period = period
+        self.entities = entities
+        self.free = Ring(self.SIZE)
+        # time.time() of the free heap samples; the loop, bursts and sleeps
+        # space them differently
+        self.times = Ring(self.SIZE)
+        self.largest = Ring(self.SIZE // self.LARGEST_EVERY + 1)
+        self.growth = [Ring(self.SIZE) for _ in self.PHASES]
+        self.samples = 0
+        self.mark_alloc = 0
+        self.last_publish = time.time()
+        # A document of its own keeps the node's state messages small
+        self.node = None
+        if node_id:
+            self.node = ha_api.Node(mqtt, node_id, object_id=node_id + "_diag")
+        self.sensors = discovery.diag_sensors(
+            mqtt, self.PHASES, [entity.eid for entity in entities], self.node,
+            node_id)
+
+    def start(self):
+        "Begin attributing heap growth to phases"
+        self.mark_alloc = gc.mem_alloc()
+
+    def mark(self, phase):
+        "Heap growth since start() or the previous mark() belongs to phase"
+        now = gc.mem_alloc()
+        growth = now - self.mark_alloc
+        self.mark_alloc = now
+        # A collection inside the phase hides what it allocated
+        if growth >= 0:
+            self.growth[phase].put(growth)
+
+    def sample(self):
+        "Call right after gc.collect()"
+        free = gc.mem_free()
+        self.free.put(free)
+        self.times.put(time.time())
+        if self.samples % self.LARGEST_EVERY == 0:
+            self.largest.put(largest_block(free, self.LARGEST_LIMIT,
+                                           self.LARGEST_STEP))
+        self.samples += 1
+
+    def publish(self, now=None):
+        if now is None:
+            now = time.time()
+        if now - self.last_publish < self.period:
+            return
+        self.last_publish = now
+        sensors = self.sensors
+        sensors[0].update(self.free.min())
+        sensors[1].update(self.free.max())
+        sensors[2].update(int(self.free.slope(self.times) * 3600))
+        sensors[3].update(self.largest.min())
+        for i, ring in enumerate(self.growth):
+            sensors[4 + i].update(ring.max())
+        first = 4 + len(self.growth)
+        for i, entity in enumerate(self.entities):
+            sensors[first + i].update(entity.stats.rejected)
+        if self.node is not None:
+            self.node.flush()
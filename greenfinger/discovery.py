@@ -0,0 +1,118 @@
+"""
+Home Assistant entities exposed by a node.
+
+Kept free of hardware imports, so tools/gen_ha_frozen.py can create the
+same entities on the host and precompile their discovery payloads.
+A node_id puts the topics of the entities below the node's own, so
+several nodes don't overwrite each other's retained configs.
+"""
+import ha_api
+
+
+def fnv1a(data):
+    "32-bit FNV-1a; stable across builds and ports, unlike hash()"
+    h = 0x811c9dc5
+    for byte in data:
+        h = ((h ^ byte) * 0x01000193) & 0xffffffff
+    return h
+
+
+def entity_table(cfg):
+    """
+    (id, probe, pump pin, target moisture, water time[, pump mA]) of each
+    entity
+    """
+    table = getattr(cfg, "ENTITIES", None)
+    if table is None:
+        # Configs from before the ENTITIES table
+        table = (
+            ("a", cfg.HUM_SENSOR_A, cfg.PUMP_A,
+             cfg.TARGET_MOISTURE_A, cfg.WATER_TIME_A),
+            ("b", cfg.HUM_SENSOR_B, cfg.PUMP_B,
+             cfg.TARGET_MOISTURE_B, cfg.WATER_TIME_B),
+        )
+    return table
+
+
+def layout_hash(cfg):
+    "Hash of the config the entities below depend on; see ha_frozen.py"
+    # The leading version counts changes of the topics themselves
+    key = repr((2, getattr(cfg, "HA_NODE_ID", None) or None,
+                [row[0] for row in entity_table(cfg)],
+                bool(getattr(cfg, "DIAG_PERIOD", None))))
+    return fnv1a(key.encode())
+
+
+def air_sensors(mqtt, node=None, node_id=None):
+    temp = ha_api.Sensor(mqtt, "Air temperature",
+                         unit="C",
+                         device_class="temperature",
+                         object_id="greenfinger_air_temp",
+                         node=node, node_id=node_id)
+
+    humidity = ha_api.Sensor(mqtt, "Air humidity",
+                             unit="%",
+                             device_class="humidity",
+                             object_id="greenfinger_air_humidity",
+                             node=node, node_id=node_id)
+    return temp, humidity
+
+
+def entity_sensors(mqtt, eid, node=None, node_id=None):
+    pump = ha_api.BinarySensor(mqtt, "Pump: " + eid,
+                               device_class="motion",
+                               object_id="greenfinger_pump_" + eid,
+                               node=node, node_id=node_id)
+
+    moisture = ha_api.Sensor(mqtt, "Moisture: " + eid,
+                             unit="%",
+                             device_class="humidity",
+                             object_id="greenfinger_moisture_" + eid,
+                             node=node, node_id=node_id)
+    return pump, moisture
+
+
+def entity_commands(mqtt, commands, eid, water, set_target, node=None,
+                    node_id=None):
+    water_now = ha_api.Button(mqtt, "Water now: " + eid, water,
+                              object_id="greenfinger_water_" + eid,
+                              commands=commands, node_id=node_id)
+
+    target = ha_api.Number(mqtt, "Target moisture: " + eid, set_target,
+                           object_id="greenfinger_target_" + eid,
+                           commands=commands,
+                           minimum=0, maximum=100, step=1, unit="%",
+                           node=node, node_id=node_id)
+    return water_now, target
+
+
+def node_commands(mqtt, commands, triage, node_id=None):
+    return ha_api.Button(mqtt, "Triage now", triage,
+                         object_id="greenfinger_triage",
+                         commands=commands, node_id=node_id)
+
+
+def diag_sensors(mqtt, phases, eids=(), node=None, node_id=None):
+    """
+    Heap statistics of diag.Diag and readings rejected as outliers per
+    entity, in the diagnostic section of the device
+    """
+    def sensor(key, name, unit, device_class="data_size"):
+        return ha_api.Sensor(mqtt, name, unit=unit, device_class=device_class,
+                             object_id="greenfinger_diag_" + key,
+                             node=node, node_id=node_id,
+                             entity_category="diagnostic")
+
+    sensors = [
+        sensor("heap_min", "Free heap min", "B"),
+        sensor("heap_max", "Free heap max", "B"),
+        sensor("heap_trend", "Free heap trend", "B/h", None),
+        sensor("block_min", "Largest free block min", "B"),
+    ]
+    for phase in phases:
+        sensors.append(sensor("growth_" + phase, "Heap growth in " + phase,
+                              "B"))
+    for eid in eids:
+        sensors.append(sensor("rejected_" + eid, "Rejected readings: " + eid,
+                              None, None))
+    return sensors
@@ -5,18 +5,19 @@ import utime as time
 import gc
 import network
 # Import big modules early
-from umqttrobust import MQTTClient
+from umqttrobust import MQTTClient, OfflineQueue
 gc.collect()
 
 from machine import Pin, I2C
-import dht
 import config as cfg
 import ha_api
+import discovery
 
 gc.collect()
 
-from model import Entity
-import ssd1306
+from model import Entity, PumpScheduler, SamplePolicy, Scanner, to_percent
+from model import ADS1115, Mux, ProbeBank
+# ssd1306 and dht are imported when their devices are set up
 
 gc.collect()
 print("RAM 0:", gc.mem_free())
@@ -34,45 +35,121 @@ def connect():
 
 
 class Display:
-    def __init__(self, scl=13, sda=4):
-        self.i2c = I2C(-1, scl=Pin(scl), sda=Pin(sda))
+    SPACING = 8
+    DIM_CONTRAST = 0x01
+
+    def __init__(self, scl=13, sda=4, dim_after=None, off_after=None, i2c=None):
+        import ssd1306
+        if i2c is None:
+            i2c = I2C(-1, scl=Pin(scl), sda=Pin(sda))
+        self.i2c = i2c
         self.oled = ssd1306.SSD1306_I2C(128, 32, self.i2c)
         self.oled.fill(0)
         self.oled.text("Initialized", 0, 0)
         self.oled.show()
 
+        # Source values of each drawn line
+        self.keys = []
+        self.dim_after = dim_after
+        self.off_after = off_after
+        self.last_activity = 0
+        self.dimmed = False
+        self.off = False
+        # First entity shown, when they don't all fit
+        self.first = 0
+
+    def _changed(self, line, a, b=None, c=None, d=None):
+        keys = self.keys
+        while len(keys) <= line:
+            keys.append([None, None, None, None])
+        key = keys[line]
+        if key[0] == a and key[1] == b and key[2] == c and key[3] == d:
+            return False
+        key[0] = a
+        key[1] = b
+        key[2] = c
+        key[3] = d
+        return True
+
+    def _draw(self, line, msg):
+        y = line * self.SPACING
+        self.oled.fill_rect(0, y, self.oled.width, self.SPACING, 0)
+        self.oled.text(msg, 0, y)
+
+    def _power(self, uptime, activity):
+        "Dim and then blank the panel if nothing but the uptime changes"
+        if activity:
+            self.last_activity = uptime
+            if self.off:
+                self.oled.display_on()
+                self.off = False
+            if self.dimmed:
+                self.oled.contrast(0xff)
+                self.dimmed = False
+            return
+        idle = uptime - self.last_activity
+        if self.off_after and not self.off and idle >= self.off_after:
+            self.oled.poweroff()
+            self.off = True
+        elif self.dim_after and not self.dimmed and idle >= self.dim_after:
+            self.oled.contrast(self.DIM_CONTRAST)
+            self.dimmed = True
+
     def refresh(self, uptime, entities, cur_air):
-        "Given internal state, handle the UI"
-        spacing = 8
-        line = 0
-        self.oled.fill(0)
-        msg = "up={}".format(uptime)
-        self.oled.text(msg, 0, 0)
-        line += 1
-        for entity in entities:
-            msg = "{}: h{:.1f} w{}/{}"
-            msg = msg.format(entity.eid,
-                             entity.cnts["cur"],
-                             entity.cnts["waterings"],
-                             entity.cnts["triages"])
-            self.oled.text(msg, 0, line * spacing)
+        "Given internal state, handle the UI. Only changed lines are redrawn."
+        dirty = False
+        activity = False
+        minutes = uptime // 60
+        if self._changed(0, minutes):
+            self._draw(0, "up={}m".format(minutes))
+            dirty = True
+        # Uptime and air take a line each, entities page through the rest
+        rows = self.oled.height // self.SPACING - 2
+        paging = len(entities) > rows
+        if self.first >= len(entities):
+            self.first = 0
+        line = 1
+        for i in range(min(rows, len(entities))):
+            entity = entities[(self.first + i) % len(entities)]
+            if self._changed(line, entity.eid, entity.cur,
+                             entity.waterings, entity.triages):
+                if entity.cur < 0:
+                    # Not measured yet
+                    moisture = "--"
+                else:
+                    moisture = "{:.1f}".format(to_percent(entity.cur))
+                msg = "{}: h{} w{}/{}"
+                msg = msg.format(entity.eid,
+                                 moisture,
+                                 entity.waterings,
+                                 entity.triages)
+                self._draw(line, msg)
+                dirty = True
+                # Turning pages is not activity
+                activity = activity or not paging
             line += 1
+        if paging:
+            self.first = (self.first + rows) % len(entities)
 
-        msg = "{}C {}%".format(cur_air['temp'], cur_air['humid'])
-        self.oled.text(msg, 0, line * spacing)
-        self.oled.show()
+        if self._changed(line, cur_air.temp, cur_air.humid):
+            msg = "{}C {}%".format(cur_air.temp, cur_air.humid)
+            self._draw(line, msg)
+            dirty = activity = True
+
+        self._power(uptime, activity)
+        if dirty and not self.off:
+            self.oled.show()
 
 
 class AirState:
     UPDATE_CYCLE = 10
     def __init__(self, pin, offset_temp, offset_humid):
+        import dht
         self.pin = Pin(pin, Pin.OUT, Pin.PULL_UP)
         self.dht = dht.DHT11(self.pin)
-        self.state = {
-            'temp': -1,
-            'humid': -1,
-            'error': False,
-        }
+        self.temp = -1
+        self.humid = -1
+        self.error = False
         self.offset_temp = offset_temp
         self.offset_humid = offset_humid
         self.last_read = 0
@@ -83,104 +160,562 @@ class AirState:
     def _update(self):
         try:
             self.dht.measure()
-            self.state['temp'] = self.dht.temperature() + self.offset_temp
-            self.state['humid'] = self.dht.humidity() + self.offset_humid
-            self.state['error'] = False
+            self.temp = self.dht.temperature() + self.offset_temp
+            self.humid = self.dht.humidity() + self.offset_humid
+            self.error = False
         except OSError as e:
             print("Error while updating DHT", e)
-            self.state['error'] = True
+            self.error = True
 
     def get(self):
         now = time.time()
         if now > self.last_read + self.UPDATE_CYCLE:
             self._update()
             self.last_read = now
-        return self.state
+        return self
 
 
 class GreenFinger:
     "Tend to the flowers"
     MAIN_CYCLE = 10 * 60
-    def __init__(self, mqtt, entities, air_state, display):
+
+    # Task periods of the asyncio runtime, in seconds
+    MEASURE_CYCLE = 10
+    DISPLAY_CYCLE = 10
+    AIR_CYCLE = 10
+    MQTT_CYCLE = 0.2
+    PUMP_CYCLE = 0.1
+    GC_CYCLE = 10
+
+    # Longest sleep between servicing the MQTT socket, in ms
+    SERVICE_SLICE = 100
+
+    def __init__(self, mqtt, entities, air_state, display, node=None,
+                 pumps=None, node_id=None):
+        self.mqtt = mqtt
+        self.node = node
+        self.node_id = node_id
         self.entities = entities
         self.display = display
         self.air_state = air_state
+        self.scanner = Scanner(entities, Entity.add_sample)
+        self.pumps = PumpScheduler() if pumps is None else pumps
+        # ticks_ms at boot, cleared once the first measurement is reported
+        self.boot_ticks = None
+        # Work requested by MQTT commands: (function, argument)
+        self.requests = []
+        # diag.Diag, if heap instrumentation is enabled
+        self.diag = None
+        # Entities to measure this cycle, refilled by _due()
+        self.due = []
+        # A forced triage waits for the scan in progress
+        self.triage_forced = False
+        # tslog.TSLog and the query being streamed from it, if logging
+        self.log = None
+        self.log_topic = None
+        self.log_cursor = None
+        self.log_chunk = 0
         self.start = time.time()
         self.ts_last_triage = self.start
 
-        self.ha_air_temp = ha_api.Sensor(mqtt, "Air temperature",
-                                         unit="C",
-                                         device_class="temperature",
-                                         object_id="greenfinger_air_temp")
-
-        self.ha_air_humidity = ha_api.Sensor(mqtt, "Air humidity",
-                                             unit="%",
-                                             device_class="humidity",
-                                             object_id="greenfinger_air_humidity")
+        self.ha_air_temp, self.ha_air_humidity = discovery.air_sensors(
+            mqtt, node, node_id)
 
         #self.wdt = WDT(timeout=20000)
 
+    def _report_boot(self):
+        print("First measurement {} ms after boot, free heap {}".format(
+            time.ticks_diff(time.ticks_ms(), self.boot_ticks), gc.mem_free()))
+        self.boot_ticks = None
+
+    def _due(self, now):
+        due = self.due
+        del due[:]
+        for entity in self.entities:
+            if entity.due(now):
+                due.append(entity)
+        return due
+
+    def measure(self):
+        self.scanner.run(self._due(time.time()))
+        if self.boot_ticks is not None:
+            self._report_boot()
+
+    async def measure_async(self):
+        import uasyncio as asyncio
+        scanner = self.scanner
+        scanner.start(self._due(time.time()))
+        while True:
+            scanner.poll(time.ticks_ms())
+            if not scanner.busy:
+                break
+            await asyncio.sleep_ms(scanner.wait_ms(time.ticks_ms()))
+        if self.triage_forced:
+            self._force_triage(None)
+        if self.boot_ticks is not None:
+            self._report_boot()
+
+    def setup_commands(self, commands):
+        for entity in self.entities:
+            _, entity.ha_target = discovery.entity_commands(
+                self.mqtt, commands, entity.eid,
+                water=self._command(self._water, entity),
+                set_target=self._target_command(entity),
+                node=self.node, node_id=self.node_id)
+            entity.ha_target.update(entity.target_moisture)
+        discovery.node_commands(self.mqtt, commands,
+                                self._command(self._force_triage, None),
+                                self.node_id)
+
+    def setup_log(self, log, commands, topic):
+        """
+        Log triages and waterings. Publishing "start end" (timestamps, both
+        optional) to topic/query streams the records to topic/data in
+        chunks of a tslog.CHUNK header and the records.
+        """
+        self.log = log
+        self.log_topic = topic + "/data"
+        self.pumps.done = self._log_watering
+        commands.add(topic + "/query", self._log_query)
+
+    def _log_query(self, msg):
+        bounds = [int(field) for field in msg.split()]
+        bounds += [0, 0xffffffff][len(bounds):]
+        self.log_cursor = self.log.query(bounds[0], bounds[1])
+        self.log_chunk = 0
+
+    def _send_log(self):
+        "Publish the next chunk of the query, one per call"
+        import struct
+        import tslog
+        if not self.mqtt.connected:
+            return
+        chunk = self.log_cursor.read()
+        count = 0 if chunk is None else len(chunk) // tslog.RECORD_SIZE
+        payload = struct.pack(tslog.CHUNK, self.log_chunk, count)
+        if chunk is not None:
+            payload += chunk
+        self.mqtt.publish(self.log_topic, payload)
+        self.log_chunk += 1
+        if chunk is None:
+            self.log_cursor = None
+
+    def _log_watering(self, entity):
+        import tslog
+        air = self.air_state
+        self.log.append(time.time(), self.entities.index(entity), tslog.WATER,
+                        entity.water_time, air.temp, air.humid)
+
+    def _command(self, func, arg):
+        "Handler deferring the work until the message is fully processed"
+        def handler(msg):
+            self.requests.append((func, arg))
+        return handler
+
+    def _target_command(self, entity):
+        def handler(msg):
+            entity.target_moisture = float(msg)
+            entity.ha_target.update(entity.target_moisture)
+        return handler
+
+    def _water(self, entity):
+        self.pumps.request(entity)
+        self.poll_pumps()
+
+    def poll_pumps(self):
+        self.pumps.poll(time.ticks_ms())
+
+    def _force_triage(self, _):
+        if self.scanner.busy:
+            # The measure task is mid-scan; measure_async() triages after it
+            self.triage_forced = True
+            return
+        self.triage_forced = False
+        # Entities not sampled since the last triage, through the scanner,
+        # which may own their probes
+        unsampled = [entity for entity in self.entities
+                     if not entity.stats.n]
+        if unsampled:
+            self.scanner.run(unsampled)
+        for entity in self.triage_due(time.time(), force=True):
+            self._water(entity)
+
+    def run_requests(self):
+        while self.requests:
+            func, arg = self.requests.pop(0)
+            func(arg)
+
+    def triage_due(self, now, force=False):
+        "Entities which need water, if the triage cycle has passed"
+        if not force and self.ts_last_triage + self.MAIN_CYCLE >= now:
+            return ()
+        self.ts_last_triage = now
+        log = self.log
+        air = self.air_state
+        due = []
+        for i, entity in enumerate(self.entities):
+            triages = entity.triages
+            if entity.triage(force):
+                due.append(entity)
+            if log is not None and entity.triages != triages:
+                import tslog
+                log.append(now, i, tslog.MOISTURE, entity.moisture,
+                           air.temp, air.humid)
+        return due
+
+    def refresh_display(self):
+        elapsed = time.time() - self.start
+        self.display.refresh(elapsed, self.entities, self.air_state)
+
+    def publish_air(self):
+        cur_air = self.air_state.get()
+        self.ha_air_temp.update(cur_air.temp)
+        self.ha_air_humidity.update(cur_air.humid)
+
+    def service_mqtt(self):
+        try:
+            if self.node is not None:
+                self.node.flush()
+            self.mqtt.service()
+            while self.mqtt.check_msg() is not None:
+                pass
+        except Exception as e:
+            print("MQTT error", e)
+        self.run_requests()
+        if self.log_cursor is not None:
+            self._send_log()
+
+    def wait(self, seconds):
+        "Sleep, but keep servicing MQTT so commands take effect quickly"
+        deadline = time.ticks_add(time.ticks_ms(), int(seconds * 1000))
+        while True:
+            self.service_mqtt()
+            self.poll_pumps()
+            left = time.ticks_diff(deadline, time.ticks_ms())
+            if left <= 0:
+                return
+            time.sleep_ms(min(left, self.SERVICE_SLICE))
+
     def loop(self):
         i = 0
+        diag = self.diag
         while True:
             now = time.time()
 
-            for entity in self.entities:
-                entity.measure()
+            if diag is not None:
+                diag.start()
+            self.measure()
+            self.service_mqtt()
+            if diag is not None:
+                diag.mark(diag.MEASURE)
 
-            if self.ts_last_triage + self.MAIN_CYCLE < now:
-                for entity in self.entities:
-                    entity.triage()
-                self.ts_last_triage = now
+            for entity in self.triage_due(now):
+                self._water(entity)
+            if diag is not None:
+                diag.mark(diag.TRIAGE)
 
-            elapsed = now - self.start
-            cur_air = self.air_state.get()
-            self.display.refresh(elapsed, self.entities, cur_air)
+            self.air_state.get()
+            self.refresh_display()
+            if diag is not None:
+                diag.mark(diag.DISPLAY)
 
             i += 1
 
-            if i % 6 == 0:
-                # TEMPORARY: Update each time
-                self.ha_air_temp.update(cur_air['temp'])
-                self.ha_air_humidity.update(cur_air['humid'])
+            # Sensor publish policies drop the unchanged readings
+            self.publish_air()
+            if diag is not None:
+                diag.publish(now)
+
+            self.service_mqtt()
+            if diag is not None:
+                diag.mark(diag.PUBLISH)
 
             gc.collect()
+            if diag is not None:
+                diag.sample()
             if i % 10 == 0:
                 print("Free Mem: ", gc.mem_free())
             # self.wdt.feed()
-            time.sleep(10)
+            self.wait(10)
+
+    def flush_mqtt(self, timeout_ms=5000):
+        "Service MQTT until everything is sent and acknowledged"
+        mqtt = self.mqtt
+        deadline = time.ticks_add(time.ticks_ms(), timeout_ms)
+        while True:
+            self.service_mqtt()
+            queue = mqtt.queue
+            if (mqtt.connected and not mqtt.inflight and
+                    not (queue is not None and len(queue))):
+                return True
+            if time.ticks_diff(deadline, time.ticks_ms()) <= 0:
+                return False
+            time.sleep_ms(10)
+
+    def sleep_time(self, now, minimum, maximum):
+        "Seconds until the next triage or entity sample is due"
+        # triage_due() fires once MAIN_CYCLE has fully passed
+        wake = self.ts_last_triage + self.MAIN_CYCLE + 1
+        for entity in self.entities:
+            if entity.next_sample is not None and entity.next_sample < wake:
+                wake = entity.next_sample
+        seconds = wake - now
+        if seconds < minimum:
+            return minimum
+        if seconds > maximum:
+            return maximum
+        return seconds
+
+    def loop_burst(self, mode, min_sleep, max_sleep):
+        """
+        Low power: measure, triage and publish in one burst, then sleep.
+        A deep sleep ends in a reset; the state waits in the RTC memory.
+        """
+        import machine
+        while True:
+            now = time.time()
+            self.measure()
+            for entity in self.triage_due(now):
+                self._water(entity)
+            self.air_state.get()
+            self.refresh_display()
+            self.publish_air()
+            # Pumps must not be left running through the sleep
+            while self.pumps.busy:
+                self.wait(1)
+            if self.diag is not None:
+                self.diag.publish(now)
+            self.flush_mqtt()
+            gc.collect()
+            if self.diag is not None:
+                self.diag.sample()
+
+            seconds = self.sleep_time(time.time(), min_sleep, max_sleep)
+            deep = mode == "deep"
+            if deep:
+                import persist
+                # State that wasn't saved stays in RAM, through a light sleep
+                deep = persist.save(self)
+                if deep and self.log is not None:
+                    # The RAM buffer doesn't survive
+                    self.log.flush()
+            # The sleep outlasts the keepalive and the broker would drop
+            # us; subscriptions are restored on the reconnect
+            self.mqtt.disconnect()
+            if deep:
+                machine.deepsleep(seconds * 1000)
+            else:
+                machine.lightsleep(seconds * 1000)
+                if self.mqtt.queue is None:
+                    # Without a queue publish() expects a connection
+                    self.mqtt.reconnect()
+
+    async def _every(self, period, func, coro=False, phase=None):
+        """
+        Call func each period seconds, scheduled against a fixed deadline.
+        Heap growth of a plain function is counted under the diag phase.
+        """
+        import uasyncio as asyncio
+        period_ms = int(period * 1000)
+        deadline = time.ticks_ms()
+        diag = self.diag if phase is not None else None
+        while True:
+            if coro:
+                await func()
+            elif diag is not None:
+                diag.start()
+                func()
+                diag.mark(phase)
+            else:
+                func()
+            deadline = time.ticks_add(deadline, period_ms)
+            delay = time.ticks_diff(deadline, time.ticks_ms())
+            if delay < 0:
+                # Overran the period; don't try to catch up.
+                deadline = time.ticks_ms()
+                delay = 0
+            await asyncio.sleep_ms(delay)
+
+    def _triage_task(self):
+        for entity in self.triage_due(time.time()):
+            self._water(entity)
+
+    def _gc_task(self):
+        gc.collect()
+        if self.diag is not None:
+            self.diag.sample()
+            self.diag.publish()
+
+    async def _main_async(self):
+        import uasyncio as asyncio
+        diag = self.diag
+        # Diag phases of the tasks; the measure coroutine interleaves with
+        # the rest, so its heap growth can't be told apart
+        triage = display = publish = None
+        if diag is not None:
+            triage, display, publish = diag.TRIAGE, diag.DISPLAY, diag.PUBLISH
+        await asyncio.gather(
+            self._every(self.MEASURE_CYCLE, self.measure_async, True),
+            self._every(self.MEASURE_CYCLE, self._triage_task, phase=triage),
+            self._every(self.DISPLAY_CYCLE, self.refresh_display, phase=display),
+            self._every(self.AIR_CYCLE, self.publish_air, phase=publish),
+            self._every(self.MQTT_CYCLE, self.service_mqtt),
+            self._every(self.PUMP_CYCLE, self.poll_pumps),
+            self._every(self.GC_CYCLE, self._gc_task),
+        )
+
+    def loop_async(self):
+        "Run each phase as a separate uasyncio task"
+        import uasyncio as asyncio
+        asyncio.run(self._main_async())
 
 
 def connect_mqtt():
     ip, port = cfg.MQTT_SERVER
+    policy = OfflineQueue.DROP_OLDEST
+    if getattr(cfg, "MQTT_QUEUE_COALESCE", False):
+        policy = OfflineQueue.COALESCE
     mqtt = MQTTClient(cfg.MQTT_CLIENT_ID, server=ip, port=port,
-                      user=cfg.MQTT_USER, password=cfg.MQTT_PASS)
+                      user=cfg.MQTT_USER, password=cfg.MQTT_PASS,
+                      keepalive=getattr(cfg, "MQTT_KEEPALIVE", 0),
+                      ping_timeout=getattr(cfg, "MQTT_PING_TIMEOUT", 5),
+                      queue_size=getattr(cfg, "MQTT_QUEUE_SIZE", 0),
+                      queue_policy=policy,
+                      connect_timeout=getattr(cfg, "MQTT_CONNECT_TIMEOUT", 1))
     # user="your_username", password="your_api_key",
     # mqtt.set_callback(sub_callback)
-    mqtt.connect(clean_session=True)
+    mqtt.start(clean_session=True)
     return mqtt
 
 
-def run():
+def set_policy(sensor, deadband):
+    sensor.set_policy(deadband,
+                      min_interval=getattr(cfg, "HA_MIN_INTERVAL", 0),
+                      heartbeat=getattr(cfg, "HA_HEARTBEAT", None))
+
+
+def make_sensor(probe, banks, i2c):
+    "A GPIO number as is, or a channel of the (shared) mux/ADS1115 bank"
+    if isinstance(probe, int):
+        return probe
+    kind, channel = probe
+    bank = banks.get(kind)
+    if bank is None:
+        if kind == "mux":
+            source = Mux(cfg.PROBE_MUX_SELECT)
+        elif kind == "ads":
+            source = ADS1115(i2c, cfg.PROBE_ADS1115)
+        else:
+            raise ValueError("Unknown probe", probe)
+        bank = banks[kind] = ProbeBank(source, cfg.PROBE_POWER)
+    return bank.channel(channel)
+
+
+def pump_scheduler():
+    return PumpScheduler(max_running=getattr(cfg, "PUMP_MAX_RUNNING", 1),
+                         budget=getattr(cfg, "PUMP_BUDGET", None),
+                         pulse=getattr(cfg, "PUMP_PULSE", None),
+                         soak=getattr(cfg, "PUMP_SOAK", 60))
+
+
+def sample_policy():
+    if not getattr(cfg, "SAMPLE_MAX", None):
+        return None
+    return SamplePolicy(minimum=getattr(cfg, "SAMPLE_MIN", 10),
+                        maximum=cfg.SAMPLE_MAX,
+                        margin=getattr(cfg, "SAMPLE_MARGIN", 10),
+                        lead=getattr(cfg, "SAMPLE_LEAD", 4),
+                        boost=getattr(cfg, "SAMPLE_BOOST", 30 * 60),
+                        window=GreenFinger.MAIN_CYCLE)
+
+
+def run(boot_ticks=None):
+    "boot_ticks: ticks_ms() taken first thing in main.py, to report boot time"
     connect()
     gc.collect()
     mqtt = connect_mqtt()
     gc.collect()
 
-    entity_a = Entity("a", cfg.HUM_SENSOR_A, cfg.PUMP_A,
-                      cfg.TARGET_MOISTURE_A, cfg.WATER_TIME_A)
-    entity_b = Entity("b", cfg.HUM_SENSOR_B, cfg.PUMP_B,
-                      cfg.TARGET_MOISTURE_B, cfg.WATER_TIME_B)
-    entity_a.setup_homeassistant(mqtt)
-    entity_b.setup_homeassistant(mqtt)
+    power_mode = getattr(cfg, "POWER_MODE", None)
+    woke = False
+    if power_mode == "deep":
+        import persist
+        woke = persist.woke_from_deepsleep()
+    # Discovery configs are retained on the broker since the first boot
+    ha_api.ANNOUNCE = not woke
+    if ha_api.FROZEN and ha_api.FROZEN_LAYOUT != discovery.layout_hash(cfg):
+        print("ha_frozen.py doesn't match the config, not using it")
+        ha_api.FROZEN = {}
+
+    i2c = I2C(-1, scl=Pin(cfg.DISPLAY_SCL), sda=Pin(cfg.DISPLAY_SDA))
+    policy = sample_policy()
+    banks = {}
+    entities = []
+    pump_current = getattr(cfg, "PUMP_CURRENT", 0)
+    for row in discovery.entity_table(cfg):
+        eid, probe, pump, target, water_time = row[:5]
+        sensor = make_sensor(probe, banks, i2c)
+        entities.append(Entity(eid, sensor, pump, target, water_time, policy,
+                               row[5] if len(row) > 5 else pump_current))
+    node = None
+    node_id = getattr(cfg, "HA_NODE_ID", None) or None
+    if node_id is not None:
+        node = ha_api.Node(mqtt, node_id)
+    for entity in entities:
+        entity.setup_homeassistant(mqtt, node, node_id)
 
     air_state = AirState(pin=cfg.DHT_PIN, offset_temp=cfg.DHT_OFFSET_TEMP,
                          offset_humid=cfg.DHT_OFFSET_HUMID)
-    display = Display(scl=cfg.DISPLAY_SCL, sda=cfg.DISPLAY_SDA)
-
-
-    gf = GreenFinger(mqtt, [entity_a, entity_b], air_state, display)
+    display = Display(dim_after=getattr(cfg, "DISPLAY_DIM_AFTER", None),
+                      off_after=getattr(cfg, "DISPLAY_OFF_AFTER", None),
+                      i2c=i2c)
+
+    pumps = pump_scheduler()
+    for entity in entities:
+        if not pumps.can_run(entity):
+            raise ValueError("Pump current over PUMP_BUDGET", entity.eid)
+    if power_mode == "deep":
+        persist.check(entities)
+    gf = GreenFinger(mqtt, entities, air_state, display, node, pumps,
+                     node_id)
+    commands = ha_api.Commands(mqtt)
+    gf.setup_commands(commands)
+    gf.boot_ticks = boot_ticks
+    if getattr(cfg, "DIAG_PERIOD", None):
+        from diag import Diag
+        gf.diag = Diag(mqtt, node_id,
+                       period=cfg.DIAG_PERIOD, entities=gf.entities)
+    set_policy(gf.ha_air_temp, getattr(cfg, "HA_DEADBAND_AIR_TEMP", None))
+    set_policy(gf.ha_air_humidity, getattr(cfg, "HA_DEADBAND_AIR_HUMID", None))
+    for entity in gf.entities:
+        set_policy(entity.ha_sensor, getattr(cfg, "HA_DEADBAND_MOISTURE", None))
+
+    if getattr(cfg, "LOG_SEGMENTS", None):
+        import tslog
+        log = tslog.TSLog(
+            segments=cfg.LOG_SEGMENTS,
+            segment_records=getattr(cfg, "LOG_SEGMENT_RECORDS", 512),
+            buffer_records=getattr(cfg, "LOG_BUFFER", 16))
+        if not woke:
+            log.append(time.time(), tslog.NODE, tslog.BOOT)
+        gf.setup_log(log, commands, tslog.TOPIC.format(cfg.MQTT_CLIENT_ID))
+
+    if woke:
+        persist.restore(gf)
 
     gc.collect()
+    if boot_ticks is not None:
+        print("Setup done {} ms after boot".format(
+            time.ticks_diff(time.ticks_ms(), boot_ticks)))
     print("RAM AFTER SETUP:", gc.mem_free())
-    gf.loop()
+    try:
+        if power_mode:
+            gf.loop_burst(power_mode, getattr(cfg, "POWER_MIN_SLEEP", 60),
+                          getattr(cfg, "POWER_MAX_SLEEP", GreenFinger.MAIN_CYCLE))
+        elif getattr(cfg, "ASYNC_RUNTIME", False):
+            gf.loop_async()
+        else:
+            gf.loop()
+    finally:
+        # Don't leave a pump running into the REPL
+        gf.pumps.stop()
@@ -2,21 +2,67 @@
 # Based on the source: https://github.com/webworxshop/micropython-room-sensor/blob/master/hassnode.py
 # Redone quite a bit.
 
-import ujson as json
+try:
+    import ujson as json
+    import utime as time
+except ImportError:
+    import json
+    import time
+
+try:
+    # Discovery payloads precompiled by tools/gen_ha_frozen.py, and the
+    # discovery.layout_hash() of the config they were made for
+    from ha_frozen import CONFIGS as FROZEN, LAYOUT as FROZEN_LAYOUT
+except ImportError:
+    FROZEN = {}
+    FROZEN_LAYOUT = None
+
+# False skips publishing discovery configs, e.g. on a wake from deep sleep:
+# they are retained on the broker since the first boot.
+ANNOUNCE = True
+
+
+def topic_base(component, object_id, node_id=None,
+               discovery_prefix="homeassistant"):
+    "Topic of an entity; its config, state and command topics are below"
+    if node_id is not None:
+        fields = [discovery_prefix, component, node_id, object_id]
+    else:
+        fields = [discovery_prefix, component, object_id]
+    return "/".join(fields)
 
 
 class _Base:
     def __init__(self, mqtt, component, object_id, node_id=None,
-                 discovery_prefix="homeassistant"):
+                 discovery_prefix="homeassistant", node=None):
         self.mqtt = mqtt
-        if node_id is not None:
-            fields = [discovery_prefix, component, node_id, object_id]
+        self.object_id = object_id
+        self.node = node
+        base = topic_base(component, object_id, node_id, discovery_prefix)
+        self.config_topic = base + "/config"
+        self.command_topic = base + "/set"
+        if node is not None:
+            # State lives in a field of the node document
+            self.state_topic = node.state_topic
         else:
-            fields = [discovery_prefix, component, object_id]
+            self.state_topic = base + "/state"
+            mqtt.register_topic(self.state_topic)
 
-        base = "/".join(fields)
-        self.config_topic = base + "/config"
-        self.state_topic = base + "/state"
+    def _value_template(self):
+        return "{{ value_json." + self.object_id + " }}"
+
+    def _frozen(self):
+        """
+        Publish the precompiled config of this entity, if there is one.
+        True if the config needs no building: published or not announced.
+        """
+        if not ANNOUNCE:
+            return True
+        frozen = FROZEN.get(self.object_id)
+        if frozen is None:
+            return False
+        self.mqtt.publish(frozen[0], frozen[1], True, 1)
+        return True
 
     def _set_config(self, config):
         message = json.dumps(config).encode('utf-8')
@@ -26,27 +72,78 @@ class _Base:
         self.mqtt.publish(self.state_topic, message.encode('utf-8'))
 
 
+class Node(_Base):
+    """
+    Gathers the state of all entities of a node and publishes it as a
+    single JSON document; entities pick their field with value_template.
+    """
+    def __init__(self, mqtt, node_id, discovery_prefix="homeassistant",
+                 object_id=None):
+        "object_id: a further document of the node, below its topic"
+        if object_id is None:
+            super().__init__(mqtt, "sensor", node_id, None, discovery_prefix)
+        else:
+            super().__init__(mqtt, "sensor", object_id, node_id,
+                             discovery_prefix)
+        self.values = {}
+        self.dirty = False
+
+    def set(self, key, value, flush=False, force=False):
+        if force or self.values.get(key) != value:
+            self.values[key] = value
+            self.dirty = True
+        if flush:
+            self.flush()
+
+    def flush(self):
+        "Publish the document if anything changed since the last flush"
+        if self.dirty:
+            self.dirty = False
+            self.set_value(json.dumps(self.values))
+
+
 class BinarySensor(_Base):
-    def __init__(self, mqtt, name, device_class, object_id, node_id=None, discovery_prefix="homeassistant"):
-        super().__init__(mqtt, "binary_sensor", object_id, node_id, discovery_prefix)
+    def __init__(self, mqtt, name, device_class, object_id, node_id=None,
+                 discovery_prefix="homeassistant", node=None):
+        super().__init__(mqtt, "binary_sensor", object_id, node_id, discovery_prefix, node)
+        if node is not None:
+            # Keep the field present in the document from the start
+            node.set(object_id, "OFF")
+        if self._frozen():
+            return
         config = {
             "name": name,
             "device_class": device_class,
             "state_topic": self.state_topic
         }
+        if node is not None:
+            config['value_template'] = self._value_template()
         self._set_config(config)
 
+    def _set_state(self, state):
+        if self.node is not None:
+            # Pump state should not wait for the end of the cycle
+            self.node.set(self.object_id, state, flush=True)
+        else:
+            self.set_value(state)
+
     def on(self):
-        self.set_value("ON")
+        self._set_state("ON")
 
     def off(self):
-        self.set_value("OFF")
+        self._set_state("OFF")
 
 
 class Sensor(_Base):
     def __init__(self, mqtt, name, unit, device_class, object_id, node_id=None,
-                 value_template=None, discovery_prefix="homeassistant"):
-        super().__init__(mqtt, "sensor", object_id, node_id, discovery_prefix)
+                 value_template=None, discovery_prefix="homeassistant", node=None,
+                 entity_category=None):
+        super().__init__(mqtt, "sensor", object_id, node_id, discovery_prefix, node)
+        self.last_state = None
+        self.last_publish = 0
+        self.set_policy()
+        if self._frozen():
+            return
 
         config = {
             "name": name,
@@ -54,24 +151,140 @@ class Sensor(_Base):
             "device_class": device_class,
             "state_topic": self.state_topic,
         }
+        if value_template is None and node is not None:
+            value_template = self._value_template()
         if value_template is not None:
             config['value_template'] = value_template
+        if entity_category is not None:
+            config['entity_category'] = entity_category
         self._set_config(config)
 
+    def set_policy(self, deadband=None, relative=False, min_interval=0,
+                   heartbeat=None):
+        """
+        Skip updates which moved less than deadband (a fraction of the last
+        published value if relative) since the last publish. Publish at most
+        every min_interval seconds, but at least every heartbeat seconds.
+        """
+        self.deadband = deadband
+        self.relative = relative
+        self.min_interval = min_interval
+        self.heartbeat = heartbeat
+
+    def _due(self, state):
+        if self.last_state is None:
+            return True
+        elapsed = time.time() - self.last_publish
+        if elapsed < self.min_interval:
+            return False
+        if self.heartbeat is not None and elapsed >= self.heartbeat:
+            return True
+        if self.deadband is None:
+            return True
+        change = abs(state - self.last_state)
+        if self.relative:
+            return change > self.deadband * abs(self.last_state)
+        return change > self.deadband
+
     def update(self, state):
+        if not self._due(state):
+            return
+        self.last_state = state
+        self.last_publish = time.time()
+        if self.node is not None:
+            # The policy already decided, heartbeats must go out too
+            self.node.set(self.object_id, state, force=True)
+            return
         cmd = json.dumps(state)
         self.set_value(cmd)
 
 
+class Commands:
+    """
+    Routes incoming messages to handlers with a single lookup by topic.
+    Installs itself as the MQTT message callback.
+    """
+    def __init__(self, mqtt):
+        self.mqtt = mqtt
+        self.handlers = {}
+        mqtt.set_callback(self.dispatch)
+
+    def add(self, topic, handler):
+        self.handlers[topic.encode()] = handler
+        self.mqtt.subscribe(topic)
+
+    def dispatch(self, topic, msg, retained=False, dup=False):
+        handler = self.handlers.get(topic)
+        if handler is None:
+            return
+        try:
+            handler(msg)
+        except Exception as e:
+            print("Command failed", topic, e)
+
+
 class Switch(_Base):
-    def __init__(self, mqtt, name, callback, device_class, object_id, node_id=None,
-                 value_template=None, discovery_prefix="homeassistant"):
-        super().__init__(mqtt, "switch", object_id, node_id, discovery_prefix)
+    def __init__(self, mqtt, name, callback, device_class, object_id, commands,
+                 node_id=None, value_template=None, discovery_prefix="homeassistant",
+                 node=None):
+        super().__init__(mqtt, "switch", object_id, node_id, discovery_prefix, node)
+        commands.add(self.command_topic, callback)
+        if self._frozen():
+            return
 
         config = {
             "name": name,
             "device_class": device_class,
             "state_topic": self.state_topic,
+            "command_topic": self.command_topic,
+        }
+        if value_template is None and node is not None:
+            value_template = self._value_template()
+        if value_template is not None:
+            config['value_template'] = value_template
+        self._set_config(config)
+
+
+class Button(_Base):
+    def __init__(self, mqtt, name, callback, object_id, commands, node_id=None,
+                 discovery_prefix="homeassistant"):
+        super().__init__(mqtt, "button", object_id, node_id, discovery_prefix)
+        commands.add(self.command_topic, callback)
+        if self._frozen():
+            return
+
+        config = {
+            "name": name,
+            "command_topic": self.command_topic,
         }
         self._set_config(config)
-        self.mqtt.subscribe(self.state_topic, callback)
+
+
+class Number(_Base):
+    def __init__(self, mqtt, name, callback, object_id, commands, minimum, maximum,
+                 step=1, unit=None, node_id=None, discovery_prefix="homeassistant",
+                 node=None):
+        super().__init__(mqtt, "number", object_id, node_id, discovery_prefix, node)
+        commands.add(self.command_topic, callback)
+        if self._frozen():
+            return
+
+        config = {
+            "name": name,
+            "command_topic": self.command_topic,
+            "state_topic": self.state_topic,
+            "min": minimum,
+            "max": maximum,
+            "step": step,
+        }
+        if unit is not None:
+            config['unit_of_measurement'] = unit
+        if node is not None:
+            config['value_template'] = self._value_template()
+        self._set_config(config)
+
+    def update(self, value):
+        if self.node is not None:
+            self.node.set(self.object_id, value)
+        else:
+            self.set_value(json.dumps(value))
@@ -1,5 +1,37 @@
-import greenfinger as gf
-import time
-print("Kill now to prevent start")
-time.sleep(15)
-gf.run()
+import utime
+BOOT_TICKS = utime.ticks_ms()
+
+import machine
+import config as cfg
+
+
+def safe_boot():
+    """
+    Don't start if there is a 'safeboot' file, or SAFE_BOOT_PIN (the FLASH
+    button) is held low during SAFE_BOOT_WINDOW ms after a power-on. Resets
+    by the watchdog or from deep sleep start right away.
+    """
+    import os
+    if "safeboot" in os.listdir():
+        return True
+    pin = getattr(cfg, "SAFE_BOOT_PIN", None)
+    if pin is None:
+        return False
+    pin = machine.Pin(pin, machine.Pin.IN, machine.Pin.PULL_UP)
+    window = getattr(cfg, "SAFE_BOOT_WINDOW", 0)
+    if machine.reset_cause() in (machine.WDT_RESET, machine.DEEPSLEEP_RESET):
+        window = 0
+    deadline = utime.ticks_add(utime.ticks_ms(), window)
+    while True:
+        if pin.value() == 0:
+            return True
+        if utime.ticks_diff(deadline, utime.ticks_ms()) <= 0:
+            return False
+        utime.sleep_ms(20)
+
+
+if safe_boot():
+    print("Safe boot, not starting")
+else:
+    import greenfinger as gf
+    gf.run(BOOT_TICKS)
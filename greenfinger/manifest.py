@@ -0,0 +1,24 @@
+# Freeze greenfinger into the firmware, so its bytecode runs from flash
+# instead of being compiled into RAM at every boot:
+#
+#   make -C ports/esp8266 BOARD=ESP8266_GENERIC \
+#       FROZEN_MANIFEST=/path/to/greenfinger/manifest.py
+#
+# main.py and config.py stay on the filesystem.
+
+include("$(PORT_DIR)/boards/manifest.py")
+
+module("greenfinger.py")
+module("model.py")
+module("stats.py")
+module("discovery.py")
+module("diag.py")
+module("persist.py")
+module("tslog.py")
+module("ha_api.py")
+module("umqttsimple.py")
+module("umqttrobust.py")
+module("ssd1306.py")
+
+# Precompiled discovery payloads, see tools/gen_ha_frozen.py
+# module("ha_frozen.py")
@@ -1,116 +1,672 @@
-import time
-from machine import Pin, ADC
-import ha_api
+import utime as time
+from machine import Pin, ADC, Timer
+import discovery
+from stats import Stream
+
+_adc0 = None
+
+
+def default_adc():
+    "All probes are wired to A0 unless told otherwise; share one ADC object"
+    global _adc0
+    if _adc0 is None:
+        _adc0 = ADC(0)
+    return _adc0
+
+
+def to_percent(raw):
+    "ADC counts of a moisture reading to %"
+    return 100 * raw / 1023
+
+
+def _run(unit):
+    "Drive a measurement unit (sensor or bank) to completion, blocking"
+    unit.start(time.ticks_ms())
+    while True:
+        time.sleep_ms(max(0, time.ticks_diff(unit.deadline, time.ticks_ms())))
+        if unit.poll(time.ticks_ms()) is not None:
+            return
+
 
 class MoistureSensor:
-    def __init__(self, pin):
-        self.pin = pin
-        self.adc = ADC(0)
+    """
+    Values are raw ADC counts (small ints, no heap allocation per sample);
+    convert with to_percent() where a human or Home Assistant sees them.
+    """
+    # Acquisition phases
+    IDLE = 0
+    HIGH = 1
+    LOW = 2
+    OFF = 3
+
+    SETTLE_MS = 50
+
+    def __init__(self, pin, adc=None):
+        # Created once and switched between modes with init()
+        self.pin = Pin(pin, Pin.IN)
+        self.adc = default_adc() if adc is None else adc
+        # Measured on its own; see ProbeBank
+        self.unit = self
+        self.phase = self.IDLE
+        self.deadline = 0
+        self.val_0 = 0
+        self.val_1 = 0
+        self.value = 0
         self._power_off()
 
-    def measure(self):
+    def start(self, now):
+        "Begin a non-blocking measurement; drive it with poll()"
         try:
-            val_0 = self.adc.read()
+            self.val_0 = self.adc.read()
             self._power_high()
-            time.sleep(0.05)
-            val_1 = self.adc.read()
-            self._power_low()
-            time.sleep(0.05)
-            val_2 = self.adc.read()
-        finally:
+        except:
+            self._power_off()
+            raise
+        self.phase = self.HIGH
+        self.deadline = time.ticks_add(now, self.SETTLE_MS)
+
+    def poll(self, now):
+        "Advance the measurement; returns the value once finished, None otherwise"
+        if self.phase == self.IDLE or time.ticks_diff(self.deadline, now) > 0:
+            return None
+        try:
+            if self.phase == self.HIGH:
+                self.val_1 = self.adc.read()
+                self._power_low()
+                self.phase = self.LOW
+            elif self.phase == self.LOW:
+                val_2 = self.adc.read()
+                self._power_off()
+                # Simple denoising
+                measured = (self.val_1 - self.val_0) - (val_2 - self.val_0)
+                self.value = measured if measured > 0 else 0
+                self.phase = self.OFF
+            else:
+                # Line discharged, the ADC is free for the next probe
+                self.phase = self.IDLE
+                return self.value
+        except:
             self._power_off()
-            time.sleep(0.05)
-        # Simple denoising
-        measured = max(0, (val_1 - val_0) - (val_2 - val_0))
-        measured = 100 * measured / 1023
-        return measured
+            self.phase = self.IDLE
+            raise
+        self.deadline = time.ticks_add(now, self.SETTLE_MS)
+        return None
+
+    def want(self, sensor):
+        pass
+
+    def measure(self):
+        "Blocking measurement"
+        _run(self)
+        return self.value
 
     def _power_high(self):
-        p = Pin(self.pin, Pin.OUT)
-        p.value(1)
+        self.pin.init(Pin.OUT, value=1)
 
     def _power_low(self):
-        p = Pin(self.pin, Pin.OUT)
-        p.value(0)
+        self.pin.init(Pin.OUT, value=0)
 
     def _power_off(self):
-        Pin(self.pin, Pin.IN)
+        self.pin.init(Pin.IN)
+
+
+class Mux:
+    "CD4051/CD4067-style analog multiplexer in front of an ADC"
+    SETTLE_US = 100
+
+    def __init__(self, select, adc=None):
+        "select: GPIOs of the S0, S1, ... inputs"
+        self.select = [Pin(pin, Pin.OUT, value=0) for pin in select]
+        self.adc = default_adc() if adc is None else adc
+        self.selected = 0
+
+    def read(self, channel):
+        if channel != self.selected:
+            for i, pin in enumerate(self.select):
+                pin.value((channel >> i) & 1)
+            self.selected = channel
+            time.sleep_us(self.SETTLE_US)
+        return self.adc.read()
+
+
+class ADS1115:
+    "TI ADS1115 I2C ADC, single-shot; readings scaled to the A0 range"
+    # Start, AINx vs GND (MUX in bits 14:12), +-4.096 V, single-shot,
+    # 860 samples/s, comparator off
+    CONFIG = 0x8000 | 0x0200 | 0x0100 | 0x00e0 | 0x0003
+    CONVERSION_US = 1200
+    FULL_SCALE_MV = 4096
+
+    def __init__(self, i2c, address=0x48, vdd_mv=3300):
+        self.i2c = i2c
+        self.address = address
+        # Probes are excited with vdd; scale that to 1023 like A0
+        self.scale = self.FULL_SCALE_MV * 1023 // vdd_mv
+        self.buf = bytearray(2)
+        self.adc = self
+
+    def read(self, channel):
+        buf = self.buf
+        config = self.CONFIG | (4 + channel) << 12
+        buf[0] = config >> 8
+        buf[1] = config & 0xff
+        self.i2c.writeto_mem(self.address, 1, buf)
+        time.sleep_us(self.CONVERSION_US)
+        self.i2c.readfrom_mem_into(self.address, 0, buf)
+        if buf[0] & 0x80:
+            return 0  # Below ground, noise
+        return (buf[0] << 8 | buf[1]) * self.scale >> 15
+
+
+class BankChannel:
+    "A probe of a ProbeBank; stands in for MoistureSensor in an Entity"
+    def __init__(self, bank, channel):
+        self.unit = bank
+        self.adc = bank.adc
+        self.channel = channel
+        self.val_0 = 0
+        self.val_1 = 0
+        self.value = 0
+
+    def measure(self):
+        "Blocking measurement of this probe alone"
+        self.unit.want(self)
+        _run(self.unit)
+        return self.value
+
+
+class ProbeBank:
+    """
+    Probes excited together by one pin and read channel after channel
+    through a Mux or an ADS1115. The settling delays are paid once per
+    scan for the whole bank instead of once per probe.
+    """
+    def __init__(self, source, power_pin):
+        self.source = source
+        self.adc = source.adc
+        self.power = Pin(power_pin, Pin.IN)
+        self.phase = MoistureSensor.IDLE
+        self.deadline = 0
+        # Channels to read in the next scan
+        self.wanted = []
+
+    def channel(self, channel):
+        return BankChannel(self, channel)
+
+    def want(self, sensor):
+        if sensor not in self.wanted:
+            self.wanted.append(sensor)
+
+    def start(self, now):
+        read = self.source.read
+        try:
+            for sensor in self.wanted:
+                sensor.val_0 = read(sensor.channel)
+            self.power.init(Pin.OUT, value=1)
+        except:
+            self.power.init(Pin.IN)
+            del self.wanted[:]
+            raise
+        self.phase = MoistureSensor.HIGH
+        self.deadline = time.ticks_add(now, MoistureSensor.SETTLE_MS)
+
+    def poll(self, now):
+        "Like MoistureSensor.poll, for all wanted channels; True once done"
+        if (self.phase == MoistureSensor.IDLE or
+                time.ticks_diff(self.deadline, now) > 0):
+            return None
+        read = self.source.read
+        try:
+            if self.phase == MoistureSensor.HIGH:
+                for sensor in self.wanted:
+                    sensor.val_1 = read(sensor.channel)
+                self.power.init(Pin.OUT, value=0)
+                self.phase = MoistureSensor.LOW
+            elif self.phase == MoistureSensor.LOW:
+                for sensor in self.wanted:
+                    val_2 = read(sensor.channel)
+                    measured = (sensor.val_1 - sensor.val_0) - (val_2 - sensor.val_0)
+                    sensor.value = measured if measured > 0 else 0
+                self.power.init(Pin.IN)
+                self.phase = MoistureSensor.OFF
+            else:
+                self.phase = MoistureSensor.IDLE
+                del self.wanted[:]
+                return True
+        except:
+            self.power.init(Pin.IN)
+            self.phase = MoistureSensor.IDLE
+            del self.wanted[:]
+            raise
+        self.deadline = time.ticks_add(now, MoistureSensor.SETTLE_MS)
+        return None
+
+
+class Scanner:
+    """
+    Measure many entities at once. Units (a probe, or a bank of probes read
+    in one pass) sharing an ADC are read one after another, the others have
+    their settling windows overlapped.
+    """
+    def __init__(self, entities, callback):
+        self.entities = entities
+        self.callback = callback
+        # Entities of the current scan and the units measuring them
+        self.scan = []
+        self.pending = []
+        self.active = []
+
+    @property
+    def busy(self):
+        return bool(self.pending or self.active)
+
+    def start(self, entities=None):
+        # Refill the same lists, a scan shouldn't allocate
+        scan = self.scan
+        pending = self.pending
+        del scan[:]
+        del pending[:]
+        for entity in self.entities if entities is None else entities:
+            scan.append(entity)
+            unit = entity.sensor.unit
+            unit.want(entity.sensor)
+            if unit not in pending:
+                pending.append(unit)
+
+    def _adc_free(self, adc):
+        for unit in self.active:
+            if unit.adc is adc:
+                return False
+        return True
+
+    def poll(self, now):
+        "Advance all measurements; finished samples go to the callback"
+        i = len(self.active) - 1
+        while i >= 0:
+            unit = self.active[i]
+            try:
+                done = unit.poll(now) is not None
+            except Exception as e:
+                # The unit is idle again; its entities miss this scan
+                print("Error while measuring", e)
+                self.active.pop(i)
+                i -= 1
+                continue
+            if done:
+                self.active.pop(i)
+                for entity in self.scan:
+                    if entity.sensor.unit is unit:
+                        self.callback(entity, entity.sensor.value)
+            i -= 1
+
+        i = 0
+        while i < len(self.pending):
+            unit = self.pending[i]
+            if self._adc_free(unit.adc):
+                self.pending.pop(i)
+                try:
+                    unit.start(now)
+                except Exception as e:
+                    print("Error while measuring", e)
+                    continue
+                self.active.append(unit)
+            else:
+                i += 1
+
+    def wait_ms(self, now):
+        "Time until the nearest phase change"
+        wait = None
+        for unit in self.active:
+            left = time.ticks_diff(unit.deadline, now)
+            if wait is None or left < wait:
+                wait = left
+        return 0 if wait is None or wait < 0 else wait
+
+    def run(self, entities=None):
+        "Blocking scan"
+        self.start(entities)
+        while True:
+            self.poll(time.ticks_ms())
+            if not self.busy:
+                break
+            time.sleep_ms(self.wait_ms(time.ticks_ms()))
 
 
 class Pump:
-    def __init__(self, pin):
+    def __init__(self, pin, current=0):
         self.pin = Pin(pin, Pin.OUT)
         self.pin.value(0)
+        # Supply current drawn while running, in mA
+        self.current = current
 
-    def enable(self, seconds):
-        try:
-            # enable
-            self.pin.value(1)
-            time.sleep(seconds)
-        finally:
-            # Disable
-            self.pin.value(0)
+    def on(self):
+        self.pin.value(1)
+
+    def off(self):
+        self.pin.value(0)
+
+
+class PumpScheduler:
+    """
+    Water entities without blocking, driven by poll(). Jobs run the driest
+    plant (furthest below its target) first, as pulses with soak time in
+    between, never with more than max_running pumps or budget mA at once.
+    A job that doesn't fit waits for the running ones rather than letting
+    smaller pumps overtake it. A timer switches the pumps off at the end of
+    their pulse even if poll() is late, e.g. while MQTT blocks.
+    """
+    def __init__(self, max_running=1, budget=None, pulse=None, soak=60):
+        """
+        budget: total pump current in mA, None for no limit
+        pulse: longest single run in seconds, None waters in one go
+        soak: seconds between the pulses of a job
+        """
+        self.max_running = max_running
+        self.budget = budget
+        self.pulse_ms = None if pulse is None else int(pulse * 1000)
+        self.soak_ms = int(soak * 1000)
+        # Entities with watering left, and those pumping now
+        self.jobs = []
+        self.running = []
+        # Called with the entity once its job is done
+        self.done = None
+        self.timer = Timer(-1)
+        # Bound once, the timer callback shouldn't allocate
+        self._cutoff_cb = self._cutoff
+
+    @property
+    def busy(self):
+        return bool(self.jobs)
+
+    def can_run(self, entity):
+        "Whether the pump fits the budget at all"
+        return self.budget is None or entity.pump.current <= self.budget
+
+    def request(self, entity, seconds=None):
+        "Queue watering; False if the entity has a job already or can't run"
+        if entity in self.jobs:
+            return False
+        if not self.can_run(entity):
+            # Would block the queue for good
+            print("Pump of", entity.eid, "exceeds the budget")
+            return False
+        if seconds is None:
+            seconds = entity.water_time
+        entity.water_left = int(seconds * 1000)
+        entity.soak_end = time.ticks_ms()
+        self.jobs.append(entity)
+        return True
+
+    def _fits(self, entity):
+        if len(self.running) >= self.max_running:
+            return False
+        if self.budget is None:
+            return True
+        current = entity.pump.current
+        for other in self.running:
+            current += other.pump.current
+        return current <= self.budget
+
+    def _next(self, now):
+        "The driest entity ready for a pulse"
+        best = None
+        for entity in self.jobs:
+            if (entity in self.running or
+                    time.ticks_diff(entity.soak_end, now) > 0):
+                continue
+            if best is None or entity.deficit() > best.deficit():
+                best = entity
+        return best
+
+    def _start(self, entity):
+        pulse = entity.water_left
+        if self.pulse_ms is not None and pulse > self.pulse_ms:
+            pulse = self.pulse_ms
+        entity.water_left -= pulse
+        # Before the pump: publishing may block on a dead broker
+        if entity.ha_pump is not None:
+            entity.ha_pump.on()
+        entity.pulse_end = time.ticks_add(time.ticks_ms(), pulse)
+        entity.pump.on()
+        self.running.append(entity)
+        self._arm(time.ticks_ms())
+
+    def _arm(self, now):
+        "Time the cutoff for the nearest pulse end still ahead"
+        wait = None
+        for entity in self.running:
+            left = time.ticks_diff(entity.pulse_end, now)
+            if left > 0 and (wait is None or left < wait):
+                wait = left
+        if wait is None:
+            self.timer.deinit()
+        else:
+            self.timer.init(mode=Timer.ONE_SHOT, period=wait,
+                            callback=self._cutoff_cb)
+
+    def _cutoff(self, _):
+        "Timer callback: switch off the pumps past their pulse end"
+        now = time.ticks_ms()
+        for entity in self.running:
+            if time.ticks_diff(entity.pulse_end, now) <= 0:
+                entity.pump.off()
+        self._arm(now)
+
+    def _finish(self, entity, now):
+        entity.pump.off()
+        if entity.ha_pump is not None:
+            entity.ha_pump.off()
+        if entity.water_left > 0:
+            entity.soak_end = time.ticks_add(now, self.soak_ms)
+        else:
+            self.jobs.remove(entity)
+            entity._watered()
+            if self.done is not None:
+                self.done(entity)
+
+    def poll(self, now):
+        "Stop the pulses which are over, then start what fits"
+        i = len(self.running) - 1
+        while i >= 0:
+            entity = self.running[i]
+            if time.ticks_diff(entity.pulse_end, now) <= 0:
+                self.running.pop(i)
+                self._finish(entity, now)
+            i -= 1
+
+        while True:
+            entity = self._next(now)
+            if entity is None or not self._fits(entity):
+                return
+            self._start(entity)
+
+    def stop(self):
+        "Turn all pumps off and drop the jobs"
+        for entity in self.jobs:
+            entity.pump.off()
+            entity.water_left = 0
+        self.timer.deinit()
+        del self.running[:]
+        del self.jobs[:]
+
+
+class SamplePolicy:
+    """
+    How often an entity is measured. Rarely while moisture is well above
+    the target, often near it, when the drying trend projects reaching it
+    soon and for a while after watering. Once the readings of a triage
+    window put its mean clearly on one side of the target, the rest of
+    the window goes without.
+    """
+    # Standard errors between the window mean and the target, and readings
+    # in the window, that settle its triage
+    SETTLE = 3
+    SETTLE_SAMPLES = 3
+
+    def __init__(self, minimum=10, maximum=30 * 60, margin=10, lead=4,
+                 boost=30 * 60, window=10 * 60):
+        """
+        minimum/maximum: sampling interval bounds, in seconds
+        margin: % above the target from which on the maximum is used
+        lead: samples to take before the projected crossing of the target
+        boost: seconds of fast sampling after watering
+        window: seconds between triages
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.margin = margin
+        self.lead = lead
+        self.boost = boost
+        self.window = window
+
+    def settled(self, entity):
+        "Would more readings hardly change the triage of this window"
+        stats = entity.stats
+        if stats.n < self.SETTLE_SAMPLES:
+            return False
+        # Readings are whole counts: equal ones still leave a count of doubt
+        stderr = max(stats.stderr(), 1 / stats.n ** 0.5)
+        distance = abs(to_percent(stats.mean) - entity.target_moisture)
+        return distance > self.SETTLE * to_percent(stderr)
+
+    def interval(self, entity, now):
+        ema = entity.stats.ema
+        if ema is None or now < entity.boost_until:
+            return self.minimum
+        distance = to_percent(ema) - entity.target_moisture
+        if distance <= 0:
+            interval = 0
+        else:
+            interval = self.maximum * distance / self.margin
+            if entity.rate < 0:
+                # Seconds until the target is reached at the current drying rate
+                reach = distance / to_percent(-entity.rate)
+                if reach / self.lead < interval:
+                    interval = reach / self.lead
+        if interval < self.window and self.settled(entity):
+            interval = self.window
+        if interval < self.minimum:
+            return self.minimum
+        if interval > self.maximum:
+            return self.maximum
+        return int(interval)
 
 
 class Entity:
     """
     Sensor + Pump + Support
     """
-    def __init__(self, eid, sensor_pin, pump_pin, target_moisture, water_time):
+    # Weight of a new drying rate estimate
+    RATE_ALPHA = 0.3
+
+    def __init__(self, eid, sensor, pump_pin, target_moisture, water_time,
+                 policy=None, pump_current=0):
+        """
+        sensor: GPIO powering a probe read on A0, or a ProbeBank channel
+        pump_current: mA the pump draws, for the PumpScheduler budget
+        """
         self.eid = eid
-        self.sensor = MoistureSensor(sensor_pin)
-        self.pump = Pump(pump_pin)
+        if isinstance(sensor, int):
+            sensor = MoistureSensor(sensor)
+        self.sensor = sensor
+        self.pump = Pump(pump_pin, pump_current)
         self.target_moisture = target_moisture
         self.water_time = water_time
         self.ha_pump = None
         self.ha_sensor = None
-        self.cnts = {
-            "cnt": 0,
-            "sum": 0.0,
-            "min": 65535,
-            "max": 0,
-            "cur": -1.0,
-            "waterings": 0,
-            "triages": 0,
-        }
-
-    def setup_homeassistant(self, mqtt):
-        self.ha_pump = ha_api.BinarySensor(mqtt, "Pump: " + self.eid,
-                                           device_class="motion",
-                                           object_id="greenfinger_pump_" + self.eid)
-
-        self.ha_sensor = ha_api.Sensor(mqtt, "Moisture: " + self.eid,
-                                       unit="%",
-                                       device_class="humidity",
-                                       object_id="greenfinger_moisture_" + self.eid)
+        self.ha_target = None
+        # PumpScheduler job: ms of watering left, ticks_ms of the end of
+        # the current pulse and of the soak time after it
+        self.water_left = 0
+        self.pulse_end = 0
+        self.soak_end = 0
+        # Readings of the triage window, in raw ADC counts; spikes rejected
+        self.stats = Stream()
+        self.low = 65535
+        self.high = 0
+        self.cur = -1
+        # % average of the last triage window
+        self.moisture = None
+        self.waterings = 0
+        self.triages = 0
+        # SamplePolicy; None samples every cycle
+        self.policy = policy
+        self.next_sample = None
+        self.boost_until = 0
+        # Smoothed change of the EMA, in raw counts per second
+        self.rate = 0.0
+        self.rate_ema = None
+        self.rate_time = 0
 
-    def measure(self):
-        value = self.sensor.measure()
-        self.cnts['cnt'] += 1
-        self.cnts['sum'] += value
-        self.cnts['cur'] = value
-        self.cnts['min'] = min(self.cnts['min'], value)
-        self.cnts['max'] = max(self.cnts['max'], value)
-
-    def triage(self):
-        "Should we water the plant, or not?"
-        avg_moisture = self.cnts['sum'] / self.cnts['cnt']
-        if avg_moisture < self.target_moisture:
-            # Water.
-            try:
-                self.ha_pump.on()
-                self.pump.enable(seconds=self.water_time)
-            finally:
-                self.ha_pump.off()
-            self.cnts['waterings'] += 1
-        self.cnts['triages'] += 1
-
-        self.cnts['min'] = 65535
-        self.cnts['max'] = 0
-        self.cnts['cnt'] = 0
-        self.cnts['sum'] = 0.0
+    def deficit(self):
+        "% below the target moisture, by the last reading"
+        return self.target_moisture - to_percent(self.cur)
+
+    def due(self, now):
+        "Should the entity be measured in this cycle"
+        return self.next_sample is None or now >= self.next_sample
+
+    def _track(self, now):
+        "Update the drying rate and schedule the next sample"
+        ema = self.stats.ema
+        if self.rate_ema is not None and now > self.rate_time:
+            rate = (ema - self.rate_ema) / (now - self.rate_time)
+            self.rate += self.RATE_ALPHA * (rate - self.rate)
+        self.rate_ema = ema
+        self.rate_time = now
+        if self.policy is not None:
+            self.next_sample = now + self.policy.interval(self, now)
+
+    def _watered(self):
+        self.waterings += 1
+        if self.policy is not None:
+            now = time.time()
+            self.boost_until = now + self.policy.boost
+            self.next_sample = now
+        # The jump is not drying; start the trend over
+        self.rate = 0.0
+        self.rate_ema = None
+
+    def setup_homeassistant(self, mqtt, node=None, node_id=None):
+        self.ha_pump, self.ha_sensor = discovery.entity_sensors(
+            mqtt, self.eid, node, node_id)
+
+    def add_sample(self, value):
+        if not self.stats.add(value):
+            return
+        self._track(time.time())
+        self.cur = value
+        if value < self.low:
+            self.low = value
+        if value > self.high:
+            self.high = value
+
+    def triage(self, force=False):
+        """
+        Should we water the plant, or not? Closes the measurement window.
+        A forced triage expects the entity to be measured (by the Scanner)
+        since the last one.
+        """
+        stats = self.stats
+        if stats.n == 0 and not force and self.policy is not None:
+            # Not sampled since the last triage, so far from the target
+            return False
+        if stats.n:
+            avg_moisture = to_percent(stats.mean)
+        elif stats.filled:
+            # The reading was rejected, go by the recent ones
+            avg_moisture = to_percent(stats.median())
+        else:
+            # Never measured
+            return False
+        self.triages += 1
+        self.moisture = avg_moisture
+
+        self.low = 65535
+        self.high = 0
+        stats.reset()
 
         if self.ha_sensor:
             self.ha_sensor.update(avg_moisture)
 
-        return avg_moisture
+        return avg_moisture < self.target_moisture
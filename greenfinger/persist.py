@@ -0,0 +1,164 @@
+"""
+State carried across deep sleep.
+
+The RTC memory (492 bytes on the ESP8266) survives deep sleep but not a
+power cycle. It holds a fixed binary record: the triage timestamp and,
+per entity, its counters, sampling schedule and statistics window. That
+limits deep sleep to about 6 entities; check() refuses more at boot.
+Messages still queued for a broker that wasn't reachable go to a flash
+file instead, as they don't fit; it is written only in that case.
+"""
+import struct
+import machine
+from discovery import fnv1a
+
+MAGIC = b"GF03"
+RTC_SIZE = 492
+HEADER = "<4sBi"
+# eid hash, waterings, triages, next_sample, boost_until, rate, rate_ema,
+# rate_time, cur, target_moisture, n, mean, m2, ema, filled, pos, run,
+# rejected; followed by the readings of the median window
+ENTITY = "<IiiiiffiifHfffBBBI"
+QUEUE_FILE = "pending.json"
+
+NAN = float("nan")
+
+
+def _opt(value):
+    return NAN if value is None else value
+
+
+def _unopt(value):
+    return None if value != value else value
+
+
+def _window(stats):
+    # Readings are ADC counts, 16 bits are plenty
+    return "<%dH" % len(stats.recent)
+
+
+def eid_hash(eid):
+    "Any length of id fits"
+    return fnv1a(eid.encode())
+
+
+def woke_from_deepsleep():
+    return machine.reset_cause() == machine.DEEPSLEEP_RESET
+
+
+def pack(gf):
+    data = bytearray(struct.pack(HEADER, MAGIC, len(gf.entities),
+                                 gf.ts_last_triage))
+    for entity in gf.entities:
+        stats = entity.stats
+        next_sample = entity.next_sample
+        data += struct.pack(
+            ENTITY, eid_hash(entity.eid), entity.waterings, entity.triages,
+            -1 if next_sample is None else next_sample,
+            entity.boost_until, entity.rate, _opt(entity.rate_ema),
+            entity.rate_time, entity.cur, entity.target_moisture,
+            stats.n, stats.mean, stats.m2, _opt(stats.ema),
+            stats.filled, stats.pos, stats.run, stats.rejected)
+        data += struct.pack(_window(stats), *stats.recent)
+    return data
+
+
+def unpack(gf, data):
+    "Restore the state packed for the same entities; False if it doesn't fit"
+    if len(data) < struct.calcsize(HEADER):
+        return False
+    magic, count, ts_last_triage = struct.unpack_from(HEADER, data)
+    if magic != MAGIC or count != len(gf.entities):
+        return False
+    offset = struct.calcsize(HEADER)
+    size = struct.calcsize(ENTITY)
+    for entity in gf.entities:
+        stats = entity.stats
+        window = _window(stats)
+        if len(data) < offset + size + struct.calcsize(window):
+            return False
+        fields = struct.unpack_from(ENTITY, data, offset)
+        if fields[0] != eid_hash(entity.eid):
+            return False
+        (_, entity.waterings, entity.triages, next_sample,
+         entity.boost_until, entity.rate, rate_ema, entity.rate_time,
+         entity.cur, entity.target_moisture, stats.n, stats.mean, stats.m2,
+         ema, stats.filled, stats.pos, stats.run, stats.rejected) = fields
+        entity.next_sample = None if next_sample < 0 else next_sample
+        entity.rate_ema = _unopt(rate_ema)
+        stats.ema = _unopt(ema)
+        offset += size
+        for i, value in enumerate(struct.unpack_from(window, data, offset)):
+            stats.recent[i] = value
+        offset += struct.calcsize(window)
+        if entity.ha_target is not None:
+            entity.ha_target.update(entity.target_moisture)
+    gf.ts_last_triage = ts_last_triage
+    return True
+
+
+def size(entities):
+    "Bytes the state of the entities takes"
+    total = struct.calcsize(HEADER)
+    for entity in entities:
+        total += struct.calcsize(ENTITY)
+        total += struct.calcsize(_window(entity.stats))
+    return total
+
+
+def check(entities):
+    "Refuse entities whose state would be lost in every deep sleep"
+    if size(entities) > RTC_SIZE:
+        raise ValueError("Deep sleep state over the RTC memory",
+                         size(entities), RTC_SIZE)
+
+
+def save(gf):
+    "False if the state doesn't fit; then it must not deep sleep"
+    data = pack(gf)
+    if len(data) > RTC_SIZE:
+        print("State does not fit the RTC memory:", len(data))
+        return False
+    machine.RTC().memory(data)
+    queue = gf.mqtt.queue
+    if queue is not None and len(queue):
+        save_queue(queue)
+    return True
+
+
+def restore(gf):
+    if not unpack(gf, machine.RTC().memory()):
+        print("No saved state")
+        return False
+    queue = gf.mqtt.queue
+    if queue is not None:
+        restore_queue(queue)
+    return True
+
+
+def save_queue(queue):
+    import ujson as json
+    items = []
+    while len(queue):
+        topic, msg, retain, qos = queue.peek()
+        if isinstance(topic, bytes):
+            topic = topic.decode()
+        if isinstance(msg, bytes):
+            msg = msg.decode()
+        items.append((topic, msg, retain, qos))
+        queue.pop()
+    with open(QUEUE_FILE, "w") as f:
+        json.dump(items, f)
+
+
+def restore_queue(queue):
+    import os
+    import ujson as json
+    try:
+        with open(QUEUE_FILE) as f:
+            items = json.load(f)
+    except OSError:
+        return
+    os.remove(QUEUE_FILE)
+    for topic, msg, retain, qos in items:
+        queue.put(topic, msg, retain, qos)
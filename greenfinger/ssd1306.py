@@ -33,6 +33,8 @@ class SSD1306:
         self.height = height
         self.external_vcc = external_vcc
         self.pages = self.height // 8
+        # Copy of what the panel shows, used to send only the changed parts
+        self.shadow = bytearray(self.pages * self.width)
         # Note the subclass must initialize self.framebuf to a framebuffer.
         # This is necessary because the underlying data buffer is different
         # between I2C and SPI implementations (I2C needs an extra byte).
@@ -64,11 +66,14 @@ class SSD1306:
             SET_DISP | 0x01): # on
             self.write_cmd(cmd)
         self.fill(0)
-        self.show()
+        self.show(full=True)
 
     def poweroff(self):
         self.write_cmd(SET_DISP | 0x00)
 
+    def display_on(self):
+        self.write_cmd(SET_DISP | 0x01)
+
     def contrast(self, contrast):
         self.write_cmd(SET_CONTRAST)
         self.write_cmd(contrast)
@@ -76,9 +81,7 @@ class SSD1306:
     def invert(self, invert):
         self.write_cmd(SET_NORM_INV | (invert & 1))
 
-    def show(self):
-        x0 = 0
-        x1 = self.width - 1
+    def _window(self, x0, x1, page0, page1):
         if self.width == 64:
             # displays with width of 64 pixels are shifted by 32
             x0 += 32
@@ -87,13 +90,46 @@ class SSD1306:
         self.write_cmd(x0)
         self.write_cmd(x1)
         self.write_cmd(SET_PAGE_ADDR)
-        self.write_cmd(0)
-        self.write_cmd(self.pages - 1)
-        self.write_framebuf()
+        self.write_cmd(page0)
+        self.write_cmd(page1)
+
+    def _span(self, start, end):
+        "Changed byte range within [start, end) or None"
+        view = self.view
+        shadow = self.shadow
+        while start < end and view[start] == shadow[start]:
+            start += 1
+        if start == end:
+            return None
+        end -= 1
+        while view[end] == shadow[end]:
+            end -= 1
+        return start, end + 1
+
+    def show(self, full=False):
+        "Send pages (column spans within them) changed since the last show"
+        if full:
+            self._window(0, self.width - 1, 0, self.pages - 1)
+            self.write_framebuf()
+            self.shadow[:] = self.view
+            return
+        width = self.width
+        for page in range(self.pages):
+            offset = page * width
+            span = self._span(offset, offset + width)
+            if span is None:
+                continue
+            start, end = span
+            self._window(start - offset, end - 1 - offset, page, page)
+            self.write_data(self.view[start:end])
+            self.shadow[start:end] = self.view[start:end]
 
     def fill(self, col):
         self.framebuf.fill(col)
 
+    def fill_rect(self, x, y, w, h, col):
+        self.framebuf.fill_rect(x, y, w, h, col)
+
     def pixel(self, x, y, col):
         self.framebuf.pixel(x, y, col)
 
@@ -116,7 +152,8 @@ class SSD1306_I2C(SSD1306):
         # buffer).
         self.buffer = bytearray(((height // 8) * width) + 1)
         self.buffer[0] = 0x40  # Set first byte of data buffer to Co=0, D/C=1
-        self.framebuf = framebuf.FrameBuffer1(memoryview(self.buffer)[1:], width, height)
+        self.view = memoryview(self.buffer)[1:]
+        self.framebuf = framebuf.FrameBuffer1(self.view, width, height)
         super().__init__(width, height, external_vcc)
 
     def write_cmd(self, cmd):
@@ -129,6 +166,9 @@ class SSD1306_I2C(SSD1306):
         # hardware I2C interfaces.
         self.i2c.writeto(self.addr, self.buffer)
 
+    def write_data(self, buf):
+        self.i2c.writevto(self.addr, (b"\x40", buf))
+
     def poweron(self):
         pass
 
@@ -144,6 +184,7 @@ class SSD1306_SPI(SSD1306):
         self.res = res
         self.cs = cs
         self.buffer = bytearray((height // 8) * width)
+        self.view = memoryview(self.buffer)
         self.framebuf = framebuf.FrameBuffer1(self.buffer, width, height)
         super().__init__(width, height, external_vcc)
 
@@ -163,6 +204,14 @@ class SSD1306_SPI(SSD1306):
         self.spi.write(self.buffer)
         self.cs.high()
 
+    def write_data(self, buf):
+        self.spi.init(baudrate=self.rate, polarity=0, phase=0)
+        self.cs.high()
+        self.dc.high()
+        self.cs.low()
+        self.spi.write(buf)
+        self.cs.high()
+
     def poweron(self):
         self.res.high()
         time.sleep_ms(1)
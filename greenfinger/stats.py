@@ -0,0 +1,116 @@
+"""
+Streaming statistics of sensor readings, in fixed memory.
+
+Stream keeps, per sample in O(1):
+- Welford mean and variance of the current window (reset by the triage),
+- an exponential moving average across windows,
+- the median of the last few accepted readings,
+- outlier rejection against that median and its MAD.
+"""
+from array import array
+
+
+class Stream:
+    # Spread assumed at least this large (in reading units), so a quantized,
+    # perfectly stable signal doesn't turn every change into an outlier
+    MIN_SPREAD = 10
+    # MAD to standard deviation of a normal distribution
+    MAD_SIGMA = 1.4826
+
+    def __init__(self, window=5, alpha=0.2, reject=4.0):
+        """
+        window: readings kept for the median; alpha: EMA weight of a new
+        reading; reject: outlier threshold in (MAD-estimated) sigmas.
+        """
+        self.alpha = alpha
+        self.reject = reject
+        self.recent = array("i", bytes(4 * window))
+        self.scratch = array("i", bytes(4 * window))
+        self.pos = 0
+        self.filled = 0
+        self.ema = None
+        self.rejected = 0
+        # Outliers in a row; that many mean the level really moved
+        self.run = 0
+        self.reset()
+
+    def reset(self):
+        "Start a new window; the EMA and the median history carry over"
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def _sorted_recent(self):
+        "Recent readings, sorted in the scratch array"
+        buf = self.scratch
+        n = self.filled
+        for i in range(n):
+            value = self.recent[i]
+            j = i
+            while j > 0 and buf[j - 1] > value:
+                buf[j] = buf[j - 1]
+                j -= 1
+            buf[j] = value
+        return buf
+
+    def median(self):
+        if not self.filled:
+            return None
+        return self._sorted_recent()[self.filled // 2]
+
+    def _spread(self, median):
+        "Robust sigma: scaled median absolute deviation of the recent readings"
+        n = self.filled
+        buf = self.scratch
+        for i in range(n):
+            value = self.recent[i] - median
+            value = value if value >= 0 else -value
+            j = i
+            while j > 0 and buf[j - 1] > value:
+                buf[j] = buf[j - 1]
+                j -= 1
+            buf[j] = value
+        spread = self.MAD_SIGMA * buf[n // 2]
+        return spread if spread > self.MIN_SPREAD else self.MIN_SPREAD
+
+    def is_outlier(self, value):
+        if self.filled < len(self.recent):
+            return False
+        median = self.median()
+        return abs(value - median) > self.reject * self._spread(median)
+
+    def add(self, value):
+        "Feed a reading; returns False if it was rejected as an outlier"
+        if self.is_outlier(value):
+            self.run += 1
+            if self.run <= len(self.recent) // 2:
+                self.rejected += 1
+                return False
+            # Level shift (e.g. watering): follow it
+        else:
+            self.run = 0
+
+        self.recent[self.pos] = value
+        self.pos = (self.pos + 1) % len(self.recent)
+        if self.filled < len(self.recent):
+            self.filled += 1
+
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+        if self.ema is None:
+            self.ema = float(value)
+        else:
+            self.ema += self.alpha * (value - self.ema)
+        return True
+
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+    def stderr(self):
+        "Standard error of the window mean"
+        if self.n < 2:
+            return None
+        return (self.variance() / self.n) ** 0.5
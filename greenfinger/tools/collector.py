@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+"""
+Collect the readings of a fleet of greenfinger nodes into SQLite.
+
+One asyncio process subscribes to the state and config topics below the
+Home Assistant discovery prefix, where the nodes keep them (topics as
+built by ha_api.topic_base()), and to the flash log chunks of
+tslog.TOPIC; --node limits both to the given node ids. Entities other
+than greenfinger's and messages which don't parse are counted as
+ignored. It stores:
+
+- every numeric state value, with the time it arrived, in readings
+  (append only and unindexed, which keeps inserts cheap; queries go
+  to agg),
+- per AGG_BUCKET seconds count/sum/min/max of each series in agg,
+- flash log records (backfill, see tslog.py) in log, deduplicated,
+- names and units from the discovery configs in entities.
+
+Rows are inserted in batches, one transaction per BATCH rows or per
+FLUSH_PERIOD seconds. With --http, downsampled aggregates are served
+as JSON:
+
+    GET /series
+    GET /agg?node=greenfinger1&object_id=greenfinger_moisture_a
+            &from=UNIX&to=UNIX&step=3600
+
+--bench N publishes N node documents from another process through the
+broker and reports the ingest rate and the collector's CPU time per
+message.
+
+    python3 tools/collector.py [--host localhost] [--port 1883]
+                               [--db greenfinger.db] [--http 8080]
+                               [--node greenfinger1 ...]
+                               [--bench 100000]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sqlite3
+import struct
+import sys
+import time
+import urllib.parse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.dirname(HERE)
+sys.path.insert(0, SRC)
+
+import ha_api
+import tslog
+
+# MicroPython's time.time() counts from 2000-01-01
+EPOCH_2000 = 946684800
+
+# Object ids of the entities greenfinger creates, see discovery.py
+OBJECT_PREFIX = "greenfinger_"
+
+AGG_BUCKET = 300
+BATCH = 5000
+FLUSH_PERIOD = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    id INTEGER PRIMARY KEY, node TEXT NOT NULL, object_id TEXT NOT NULL,
+    UNIQUE (node, object_id));
+CREATE TABLE IF NOT EXISTS readings (
+    series INTEGER NOT NULL, ts REAL NOT NULL, value REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS agg (
+    series INTEGER NOT NULL, bucket INTEGER NOT NULL, count INTEGER,
+    sum REAL, min REAL, max REAL, PRIMARY KEY (series, bucket))
+    WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS log (
+    node TEXT NOT NULL, ts INTEGER NOT NULL, entity INTEGER NOT NULL,
+    kind INTEGER NOT NULL, value REAL, temp REAL, humid REAL,
+    PRIMARY KEY (node, ts, entity, kind)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS entities (
+    object_id TEXT PRIMARY KEY, component TEXT, name TEXT, unit TEXT,
+    device_class TEXT, state_topic TEXT);
+"""
+
+
+class Client:
+    "Just enough MQTT 3.1.1 over asyncio streams: QoS 0 only"
+    def __init__(self, client_id, keepalive=60):
+        self.client_id = client_id
+        self.keepalive = keepalive
+        self.reader = None
+        self.writer = None
+        self.pid = 0
+        self.pinger = None
+
+    @staticmethod
+    def _packet(kind, body):
+        header = bytearray([kind])
+        size = len(body)
+        while True:
+            byte = size & 0x7f
+            size >>= 7
+            header.append(byte | 0x80 if size else byte)
+            if not size:
+                return bytes(header) + body
+
+    @staticmethod
+    def _string(value):
+        if isinstance(value, str):
+            value = value.encode()
+        return len(value).to_bytes(2, "big") + value
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        body = (self._string(b"MQTT") + bytes([4, 0x02]) +
+                self.keepalive.to_bytes(2, "big") +
+                self._string(self.client_id))
+        self.writer.write(self._packet(0x10, body))
+        connack = await self.reader.readexactly(4)
+        if connack[0] != 0x20 or connack[3] != 0:
+            raise ConnectionError("CONNACK {}".format(connack.hex()))
+        self.pinger = asyncio.ensure_future(self._ping())
+
+    async def _ping(self):
+        while True:
+            await asyncio.sleep(self.keepalive / 2)
+            self.writer.write(b"\xc0\x00")
+
+    def subscribe(self, *topics):
+        self.pid = self.pid % 0xffff + 1
+        body = self.pid.to_bytes(2, "big")
+        for topic in topics:
+            body += self._string(topic) + b"\x00"
+        self.writer.write(self._packet(0x82, body))
+
+    def publish(self, topic, payload, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.writer.write(self._packet(0x30 | retain,
+                                       self._string(topic) + payload))
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def messages(self):
+        "Yield (topic, payload, retained) of incoming PUBLISH packets"
+        buf = bytearray()
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            buf += data
+            pos = 0
+            while True:
+                # Fixed header: type and flags, remaining length varint
+                start = pos + 1
+                size = shift = 0
+                while start < len(buf) and start < pos + 5:
+                    byte = buf[start]
+                    size |= (byte & 0x7f) << shift
+                    shift += 7
+                    start += 1
+                    if not byte & 0x80:
+                        break
+                else:
+                    break
+                end = start + size
+                if end > len(buf):
+                    break
+                flags = buf[pos]
+                if flags >> 4 == 3:
+                    length = buf[start] << 8 | buf[start + 1]
+                    body = start + 2 + length
+                    topic = buf[start + 2:body].decode()
+                    if flags & 6:
+                        body += 2
+                    yield topic, bytes(buf[body:end]), bool(flags & 1)
+                pos = end
+            del buf[:pos]
+
+    def abort(self):
+        "Forget a lost connection"
+        if self.pinger is not None:
+            self.pinger.cancel()
+            self.pinger = None
+        if self.writer is not None:
+            self.writer.close()
+
+    async def close(self):
+        if self.pinger is not None:
+            self.pinger.cancel()
+        self.writer.write(b"\xe0\x00")
+        await self.writer.drain()
+        self.writer.close()
+
+
+def number(value):
+    "State value as a float, None if it isn't a reading"
+    if value is True or value == "ON":
+        return 1.0
+    if value is False or value == "OFF":
+        return 0.0
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Store:
+    "Batched writes into the SQLite database"
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.series = {(node, object_id): sid for sid, node, object_id in
+                       self.db.execute("SELECT id, node, object_id FROM series")}
+        self.readings = []
+        self.agg = {}  # (series, bucket) -> [count, sum, min, max]
+        self.log = []
+        self.rows = 0
+
+    def _series(self, node, object_id):
+        key = (node, object_id)
+        sid = self.series.get(key)
+        if sid is None:
+            sid = self.db.execute(
+                "INSERT INTO series (node, object_id) VALUES (?, ?)",
+                key).lastrowid
+            self.series[key] = sid
+        return sid
+
+    def add(self, ts, node, object_id, value):
+        sid = self._series(node, object_id)
+        self.readings.append((sid, ts, value))
+        key = (sid, int(ts) // AGG_BUCKET * AGG_BUCKET)
+        agg = self.agg.get(key)
+        if agg is None:
+            self.agg[key] = [1, value, value, value]
+        else:
+            agg[0] += 1
+            agg[1] += value
+            if value < agg[2]:
+                agg[2] = value
+            if value > agg[3]:
+                agg[3] = value
+
+    def add_log(self, node, record):
+        ts, entity, kind, value, temp, humid = record
+        tenths = lambda v: None if v == tslog.MISSING else v / 10
+        self.log.append((node, ts + EPOCH_2000, entity, kind, tenths(value),
+                         tenths(temp), tenths(humid)))
+
+    def add_entity(self, object_id, component, config):
+        fields = [config.get(key) for key in
+                  ("name", "unit_of_measurement", "device_class", "state_topic")]
+        self.db.execute(
+            "INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?)",
+            [object_id, component] +
+            [field if isinstance(field, str) else None for field in fields])
+
+    def pending(self):
+        return len(self.readings) + len(self.log)
+
+    def flush(self):
+        if not (self.readings or self.log):
+            self.db.commit()
+            return
+        with self.db:
+            self.db.executemany("INSERT INTO readings VALUES (?, ?, ?)",
+                                self.readings)
+            self.db.executemany(
+                "INSERT INTO agg VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (series, bucket) DO UPDATE SET "
+                "count = count + excluded.count, sum = sum + excluded.sum, "
+                "min = min(min, excluded.min), max = max(max, excluded.max)",
+                [key + tuple(agg) for key, agg in self.agg.items()])
+            self.db.executemany(
+                "INSERT OR IGNORE INTO log VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self.log)
+        self.rows += len(self.readings) + len(self.log)
+        self.readings = []
+        self.agg = {}
+        self.log = []
+
+    def list_series(self):
+        return [{"node": node, "object_id": object_id, "name": name,
+                 "unit": unit}
+                for node, object_id, name, unit in self.db.execute(
+                    "SELECT node, series.object_id, name, unit FROM series "
+                    "LEFT JOIN entities USING (object_id) ORDER BY node, "
+                    "series.object_id")]
+
+    def aggregate(self, node, object_id, start, end, step):
+        "[bucket, count, mean, min, max] of the series, step seconds apart"
+        step = max(AGG_BUCKET, step // AGG_BUCKET * AGG_BUCKET)
+        sid = self.series.get((node, object_id))
+        if sid is None:
+            return []
+        return [[bucket, count, total / count, low, high]
+                for bucket, count, total, low, high in self.db.execute(
+                    "SELECT bucket / ?1 * ?1 AS b, sum(count), sum(sum), "
+                    "min(min), max(max) FROM agg WHERE series = ?2 AND "
+                    "bucket BETWEEN ?3 AND ?4 GROUP BY b ORDER BY b",
+                    (step, sid, start, end))]
+
+
+class Collector:
+    "Routes messages by topic into the store"
+    def __init__(self, store, prefix="homeassistant", nodes=("+",)):
+        self.store = store
+        self.prefix = prefix
+        self.nodes = nodes
+        self.messages = 0
+        self.ignored = 0
+
+    def topics(self):
+        topics = []
+        for node in self.nodes:
+            base = "/".join((self.prefix, "+", node))
+            # Node documents or entities without a node id, entities of a node
+            topics += [base + "/state", base + "/config",
+                       base + "/+/state", base + "/+/config",
+                       tslog.TOPIC.format(node) + "/data"]
+        return topics
+
+    def handle(self, topic, payload, now):
+        self.messages += 1
+        try:
+            if self._route(topic.split("/"), payload, now):
+                return
+        except (ValueError, struct.error):
+            # Bad JSON, text or log chunk; other publishers share the prefix
+            pass
+        self.ignored += 1
+
+    def _route(self, parts, payload, now):
+        "Store a message; False if it isn't one of ours"
+        kind = parts[-1]
+        if parts[0] == self.prefix and kind == "state":
+            if payload[:1] == b"{" and len(parts) in (4, 5):
+                # A node document: "<prefix>/sensor/<node>/state", or a
+                # further one of the node, "<prefix>/sensor/<node>/<id>/state"
+                values = json.loads(payload)
+                if not isinstance(values, dict):
+                    return False
+                self._document(parts[2], values, now)
+                return True
+            # An entity of its own, "<prefix>/<component>[/<node>]/<id>/state"
+            if not parts[-2].startswith(OBJECT_PREFIX):
+                return False
+            value = number(payload.decode())
+            node = parts[2] if len(parts) == 5 else ""
+            if value is not None:
+                self.store.add(now, node, parts[-2], value)
+                return True
+        elif parts[0] == self.prefix and kind == "config" and payload:
+            if not parts[-2].startswith(OBJECT_PREFIX):
+                return False
+            config = json.loads(payload)
+            if not isinstance(config, dict):
+                return False
+            self.store.add_entity(parts[-2], parts[1], config)
+            return True
+        elif kind == "data" and len(parts) == 4:
+            self._log_chunk(parts[1], payload)
+            return True
+        return False
+
+    def _document(self, node, values, now):
+        add = self.store.add
+        for object_id, value in values.items():
+            value = number(value)
+            if value is not None:
+                add(now, node, object_id, value)
+
+    def _log_chunk(self, node, payload):
+        size = struct.calcsize(tslog.CHUNK)
+        for record in tslog.records(payload[size:]):
+            self.store.add_log(node, record)
+
+    async def run(self, client):
+        client.subscribe(*self.topics())
+        flusher = asyncio.ensure_future(self._flush_periodically())
+        store = self.store
+        try:
+            async for topic, payload, _ in client.messages():
+                self.handle(topic, payload, time.time())
+                if store.pending() >= BATCH:
+                    store.flush()
+        finally:
+            flusher.cancel()
+            store.flush()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(FLUSH_PERIOD)
+            self.store.flush()
+
+
+async def serve_http(store, port):
+    "Minimal JSON endpoints over the aggregates"
+    async def handle(reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            target = request.split(b" ", 2)[1].decode()
+            url = urllib.parse.urlsplit(target)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            if url.path == "/series":
+                body = store.list_series()
+                status = "200 OK"
+            elif url.path == "/agg":
+                body = store.aggregate(
+                    query.get("node", ""), query["object_id"],
+                    int(query.get("from", 0)),
+                    int(query.get("to", time.time())),
+                    int(query.get("step", AGG_BUCKET)))
+                status = "200 OK"
+            else:
+                body = {"error": "not found"}
+                status = "404 Not Found"
+        except (KeyError, ValueError, IndexError) as e:
+            body = {"error": str(e)}
+            status = "400 Bad Request"
+        data = json.dumps(body).encode()
+        writer.write("HTTP/1.0 {}\r\nContent-Type: application/json\r\n"
+                     "Content-Length: {}\r\n\r\n".format(
+                         status, len(data)).encode() + data)
+        await writer.drain()
+        writer.close()
+    return await asyncio.start_server(handle, "127.0.0.1", port)
+
+
+def bench_publisher(host, port, messages, nodes):
+    "Publish node documents as fast as the broker takes them"
+    async def publish():
+        client = Client("collector-bench-pub")
+        await client.connect(host, port)
+        topics = [ha_api.topic_base("sensor", "bench{}".format(i)) + "/state"
+                  for i in range(nodes)]
+        for i in range(messages):
+            doc = {"greenfinger_air_temp": 20 + i % 7,
+                   "greenfinger_air_humidity": 40 + i % 13,
+                   "greenfinger_moisture_a": 30.5 + i % 11,
+                   "greenfinger_moisture_b": 25.5 + i % 9,
+                   "greenfinger_pump_a": "OFF",
+                   "greenfinger_pump_b": "ON" if i % 50 == 0 else "OFF",
+                   "greenfinger_target_a": 5, "greenfinger_target_b": 5}
+            client.publish(topics[i % nodes], json.dumps(doc))
+            if i % 100 == 0:
+                await client.drain()
+        client.publish("collector/bench/done", b"")
+        await client.close()
+    asyncio.run(publish())
+
+
+async def bench(args, store):
+    collector = Collector(store, args.prefix)
+    client = Client("collector-bench")
+    await client.connect(args.host, args.port)
+    client.subscribe("collector/bench/done", *collector.topics())
+    await client.drain()
+    await asyncio.sleep(0.5)  # Subscribed before the publisher starts
+
+    publisher = multiprocessing.Process(
+        target=bench_publisher,
+        args=(args.host, args.port, args.bench, args.bench_nodes))
+    publisher.start()
+    started = cpu = None
+    async for topic, payload, _ in client.messages():
+        if started is None:
+            started = time.monotonic()
+            cpu = time.process_time()
+        if topic == "collector/bench/done":
+            break
+        collector.handle(topic, payload, time.time())
+        if store.pending() >= BATCH:
+            store.flush()
+    store.flush()
+    wall = time.monotonic() - started
+    cpu = time.process_time() - cpu
+    publisher.join()
+    await client.close()
+
+    print("{} messages ({} rows) in {:.2f}s: {:.0f} msg/s, {:.0f} rows/s".format(
+        collector.messages, store.rows, wall, collector.messages / wall,
+        store.rows / wall))
+    print("collector CPU: {:.2f}s, {:.1f} us/message; {} ignored".format(
+        cpu, cpu / max(1, collector.messages) * 1e6, collector.ignored))
+
+
+async def collect(args, store):
+    server = None
+    if args.http:
+        server = await serve_http(store, args.http)
+    collector = Collector(store, args.prefix, args.node or ("+",))
+    while True:
+        client = Client(args.client_id)
+        try:
+            await client.connect(args.host, args.port)
+            print("Connected to", args.host, args.port)
+            await collector.run(client)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError) as e:
+            print("Connection lost:", e)
+        finally:
+            client.abort()
+        await asyncio.sleep(5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--db", default="greenfinger.db")
+    parser.add_argument("--prefix", default="homeassistant",
+                        help="discovery prefix")
+    parser.add_argument("--client-id", default="greenfinger-collector")
+    parser.add_argument("--node", action="append",
+                        help="collect this node only; repeat for more "
+                             "(default: all)")
+    parser.add_argument("--http", type=int, metavar="PORT",
+                        help="serve aggregates on this port")
+    parser.add_argument("--bench", type=int, metavar="N",
+                        help="measure ingesting N node documents and exit")
+    parser.add_argument("--bench-nodes", type=int, default=1000)
+    args = parser.parse_args()
+
+    store = Store(args.db)
+    try:
+        if args.bench:
+            asyncio.run(bench(args, store))
+        else:
+            asyncio.run(collect(args, store))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.flush()
+
+
+if __name__ == "__main__":
+    main()
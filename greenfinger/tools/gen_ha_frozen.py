@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Precompile Home Assistant discovery payloads of a node.
+
+Runs on the host: creates the node's ha_api entities the same way the
+device does, records the retained config messages and writes them as
+ready-to-send byte strings into ha_frozen.py. Upload (or freeze) that
+module along with the rest; ha_api then publishes it directly instead of
+building and JSON-encoding the configs at boot.
+
+Rerun whenever config.py or the entity layout changes; the device builds
+the configs itself when the module was made for other entities.
+
+    python3 tools/gen_ha_frozen.py [-c config.py] [-o ha_frozen.py]
+"""
+import argparse
+import builtins
+import json
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.dirname(HERE)
+
+
+class Recorder:
+    "Stands in for the MQTT client and keeps the discovery messages"
+    def __init__(self):
+        self.configs = []
+
+    def register_topic(self, topic):
+        pass
+
+    def set_callback(self, callback):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        if isinstance(topic, str) and topic.endswith("/config"):
+            self.configs.append((topic, msg))
+
+
+def load_config(path):
+    # config.py uses MicroPython's const()
+    builtins.const = lambda value: value
+    scope = {}
+    with open(path) as f:
+        exec(compile(f.read(), path, "exec"), scope)
+    return argparse.Namespace(**{k: v for k, v in scope.items()
+                                 if k.isupper()})
+
+
+def generate(cfg):
+    sys.path.insert(0, SRC)
+    import ha_api
+    import discovery
+    # Never pick up a stale, previously generated module
+    ha_api.FROZEN = {}
+
+    mqtt = Recorder()
+    node = None
+    node_id = getattr(cfg, "HA_NODE_ID", None) or None
+    if node_id is not None:
+        node = ha_api.Node(mqtt, node_id)
+    commands = ha_api.Commands(mqtt)
+    discovery.air_sensors(mqtt, node, node_id)
+    for row in discovery.entity_table(cfg):
+        eid = row[0]
+        discovery.entity_sensors(mqtt, eid, node, node_id)
+        discovery.entity_commands(mqtt, commands, eid, None, None, node,
+                                  node_id)
+    discovery.node_commands(mqtt, commands, None, node_id)
+    if getattr(cfg, "DIAG_PERIOD", None):
+        from diag import Diag
+        diag_node = None
+        if node is not None:
+            diag_node = ha_api.Node(mqtt, node_id,
+                                    object_id=node_id + "_diag")
+        eids = [row[0] for row in discovery.entity_table(cfg)]
+        discovery.diag_sensors(mqtt, Diag.PHASES, eids, diag_node, node_id)
+
+    configs = {}
+    for topic, msg in mqtt.configs:
+        payload = json.loads(msg)
+        object_id = topic.split("/")[-2]
+        configs[object_id] = (topic.encode(),
+                              json.dumps(payload, separators=(",", ":")).encode())
+    return configs, discovery.layout_hash(cfg)
+
+
+def write(configs, layout, path):
+    with open(path, "w") as f:
+        f.write("# Generated by tools/gen_ha_frozen.py, do not edit.\n")
+        f.write("LAYOUT = {!r}\n".format(layout))
+        f.write("CONFIGS = {\n")
+        for object_id in sorted(configs):
+            topic, payload = configs[object_id]
+            f.write("    {!r}: (\n        {!r},\n        {!r}),\n".format(
+                object_id, topic, payload))
+        f.write("}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-c", "--config", default=os.path.join(SRC, "config.py"))
+    parser.add_argument("-o", "--output", default=os.path.join(SRC, "ha_frozen.py"))
+    args = parser.parse_args()
+
+    configs, layout = generate(load_config(args.config))
+    write(configs, layout, args.output)
+    size = sum(len(topic) + len(payload) for topic, payload in configs.values())
+    print("Wrote {} configs, {} bytes to {}".format(len(configs), size, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+Load a broker with a fleet of simulated greenfinger nodes.
+
+Every node is the device's own umqttsimple.MQTTClient creating its
+Home Assistant entities through discovery/ha_api, running on CPython
+over real sockets. Nodes are spread over a process pool; each process
+multiplexes its share. The run goes through the phases of a power cut:
+
+1. all nodes connect at once,
+2. all nodes publish their discovery configs (QoS 1, retained),
+3. ROUNDS state documents per node, INTERVAL seconds apart, with QoS 1.
+
+Reported: connection rate, per-node discovery latency (first config sent
+to last config acknowledged), QoS 1 PUBACK latency and, if the broker
+publishes $SYS (mosquitto does every sys_interval, 10 s by default),
+broker-side message and byte rates.
+
+Use a scratch broker: discovery configs are retained on the real topics,
+below each node's id. They are cleared at the end unless --keep is given.
+
+    python3 tools/loadgen.py [--host localhost] [--port 1883] [--nodes 500]
+                             [--procs N] [--rounds 5] [--interval 2]
+"""
+import argparse
+import builtins
+import json
+import multiprocessing
+import os
+import select
+import socket
+import sys
+import threading
+import time
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.dirname(HERE)
+
+SYS_TOPICS = (b"$SYS/broker/messages/received", b"$SYS/broker/bytes/received",
+              b"$SYS/broker/messages/sent", b"$SYS/broker/bytes/sent")
+
+
+class HostSocket:
+    "usocket-like wrapper: readinto/write on a CPython socket"
+    def __init__(self, *args):
+        self.sock = socket.socket(*args)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sent = 0
+
+    def connect(self, addr):
+        self.sock.connect(addr)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self, n):
+        return self.sock.recv(n)
+
+    def readinto(self, buf):
+        return self.sock.recv_into(buf)
+
+    def write(self, buf, length=-1):
+        if isinstance(buf, str):
+            buf = buf.encode()
+        if length >= 0:
+            buf = memoryview(buf)[:length]
+        self.sock.sendall(buf)
+        self.sent += len(buf)
+        return len(buf)
+
+    def close(self):
+        self.sock.close()
+
+
+def install_host_modules():
+    "Map the MicroPython modules umqttsimple and ha_api use onto CPython"
+    def module(name, **attrs):
+        mod = types.ModuleType(name)
+        mod.__dict__.update(attrs)
+        sys.modules[name] = mod
+
+    builtins.const = lambda value: value
+    module("usocket", socket=HostSocket,
+           getaddrinfo=lambda host, port: socket.getaddrinfo(
+               host, port, socket.AF_INET, socket.SOCK_STREAM))
+    module("uselect", poll=select.poll,
+           POLLIN=select.POLLIN, POLLOUT=select.POLLOUT)
+    module("utime", time=time.time, sleep=time.sleep,
+           sleep_ms=lambda ms: time.sleep(ms / 1000),
+           ticks_ms=lambda: int(time.monotonic() * 1000),
+           ticks_add=lambda ticks, delta: ticks + delta,
+           ticks_diff=lambda end, start: end - start)
+    sys.modules["ujson"] = json
+    sys.path.insert(0, SRC)
+
+
+class FleetNode:
+    "One simulated device and the timings of its QoS 1 publishes"
+    def __init__(self, index, host, port, umqttsimple):
+        self.node_id = "loadgen{}".format(index)
+        self.mqtt = umqttsimple.MQTTClient(self.node_id, host, port,
+                                           socket_timeout=30)
+        self.mqtt.set_callback_status(self._status)
+        self.sent = {}  # pid -> time sent
+        self.acks = []
+        self.lost = 0
+        self.last_ack = 0
+        self.node = None
+        self.configs = set()
+
+    def _status(self, pid, status):
+        sent = self.sent.pop(pid, None)
+        if sent is None:
+            return
+        if status == 1:
+            self.last_ack = time.monotonic()
+            self.acks.append(self.last_ack - sent)
+        else:
+            self.lost += 1
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        "ha_api publishes through here to get its QoS 1 pids timed"
+        if topic.endswith("/config"):
+            self.configs.add(topic)
+        sent = time.monotonic()
+        pid = self.mqtt.publish(topic, msg, retain, qos)
+        if pid is not None:
+            self.sent[pid] = sent
+        return pid
+
+    def __getattr__(self, name):
+        return getattr(self.mqtt, name)
+
+    def discover(self):
+        import ha_api
+        import discovery
+        self.node = ha_api.Node(self, self.node_id)
+        commands = ha_api.Commands(self)
+        node_id = self.node_id
+        discovery.air_sensors(self, self.node, node_id)
+        for eid in ("a", "b"):
+            discovery.entity_sensors(self, eid, self.node, node_id)
+            discovery.entity_commands(self, commands, eid, None, None,
+                                      self.node, node_id)
+        discovery.node_commands(self, commands, None, node_id)
+
+    def poll(self):
+        while self.mqtt.check_msg() is not None:
+            pass
+
+    def busy(self):
+        return bool(self.sent)
+
+
+class Fleet:
+    "The nodes of one worker, polled only when their socket has data"
+    # check_msg() on an idle socket blocks for a millisecond, which would
+    # add up across the fleet and show as broker latency
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.by_fd = {node.mqtt.sock.fileno(): node for node in nodes}
+        self.poller = select.poll()
+        for fd in self.by_fd:
+            self.poller.register(fd, select.POLLIN)
+
+    def service(self, timeout_ms=0):
+        for fd, _ in self.poller.poll(timeout_ms):
+            self.by_fd[fd].poll()
+
+    def drain(self, timeout):
+        "Read acks until no node has a QoS 1 publish outstanding"
+        deadline = time.monotonic() + timeout
+        while (any(node.busy() for node in self.nodes) and
+               time.monotonic() < deadline):
+            self.service(50)
+
+
+def run_nodes(job):
+    "Worker: connect, discover and publish for a slice of the fleet"
+    first, count, opts = job
+    install_host_modules()
+    import umqttsimple
+    import ha_api
+    ha_api.FROZEN = {}
+
+    result = {"connect": [], "connect_start": None, "connect_end": None,
+              "discovery": [], "acks": [], "lost": 0, "errors": 0,
+              "bytes": 0, "config_topics": set()}
+    nodes = []
+    result["connect_start"] = time.time()
+    for index in range(first, first + count):
+        node = FleetNode(index, opts["host"], opts["port"], umqttsimple)
+        started = time.monotonic()
+        try:
+            node.mqtt.connect()
+        except Exception as e:
+            print("Node", index, "connect failed:", e, file=sys.stderr)
+            result["errors"] += 1
+            continue
+        result["connect"].append(time.monotonic() - started)
+        nodes.append(node)
+    result["connect_end"] = time.time()
+
+    fleet = Fleet(nodes)
+    started = {}
+    for node in nodes:
+        started[node] = time.monotonic()
+        node.discover()
+        fleet.service()
+    fleet.drain(opts["timeout"])
+    for node in nodes:
+        if node.acks:
+            result["discovery"].append(node.last_ack - started[node])
+        result["config_topics"] |= node.configs
+
+    for node in nodes:
+        node.acks = []
+    for round_ in range(opts["rounds"]):
+        round_start = time.monotonic()
+        for node in nodes:
+            node.node.set("round", round_)
+            node.publish(node.node.state_topic,
+                         json.dumps(node.node.values), False, 1)
+            fleet.service()
+        fleet.drain(opts["timeout"])
+        left = opts["interval"] - (time.monotonic() - round_start)
+        if left > 0 and round_ + 1 < opts["rounds"]:
+            time.sleep(left)
+
+    for node in nodes:
+        result["acks"].extend(node.acks)
+        result["lost"] += node.lost + len(node.sent)
+        result["bytes"] += node.mqtt.sock.sent
+        try:
+            node.mqtt.disconnect()
+        except Exception:
+            pass
+    return result
+
+
+class SysMonitor(threading.Thread):
+    "Samples the broker's $SYS counters during the run"
+    def __init__(self, host, port):
+        super().__init__(daemon=True)
+        import umqttsimple
+        self.mqtt = umqttsimple.MQTTClient("loadgen-monitor", host, port)
+        self.mqtt.set_callback(self._message)
+        self.samples = {}  # topic -> [(time, value)]
+        self.running = True
+
+    def _message(self, topic, msg, retained, dup):
+        try:
+            value = float(msg)
+        except ValueError:
+            return
+        self.samples.setdefault(topic, []).append((time.monotonic(), value))
+
+    def _connect(self):
+        self.mqtt.connect()
+        for topic in SYS_TOPICS:
+            self.mqtt.subscribe(topic)
+
+    def start(self):
+        self._connect()
+        super().start()
+
+    def run(self):
+        while self.running:
+            try:
+                self.mqtt.check_msg()
+            except Exception as e:
+                # A broker hiccup costs samples, not the monitor
+                print("$SYS monitor:", e, file=sys.stderr)
+                self._reconnect()
+            time.sleep(0.05)
+
+    def _reconnect(self):
+        try:
+            self.mqtt.sock.close()
+        except Exception:
+            pass
+        try:
+            self._connect()
+        except Exception as e:
+            print("$SYS monitor reconnect:", e, file=sys.stderr)
+            time.sleep(1)
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+    def rates(self):
+        "Per-second rate of each counter between its first and last sample"
+        rates = {}
+        for topic, samples in self.samples.items():
+            (t0, v0), (t1, v1) = samples[0], samples[-1]
+            if t1 > t0:
+                rates[topic.decode().split("/", 2)[2]] = (v1 - v0) / (t1 - t0)
+        return rates
+
+
+def percentiles(values):
+    if not values:
+        return "n/a"
+    values = sorted(values)
+    pick = lambda f: values[min(len(values) - 1, int(len(values) * f))] * 1000
+    return "p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms".format(
+        pick(0.5), pick(0.9), pick(0.99), values[-1] * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--nodes", type=int, default=500)
+    parser.add_argument("--procs", type=int, default=os.cpu_count())
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="state documents published per node")
+    parser.add_argument("--interval", type=float, default=2,
+                        help="seconds between rounds")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="give up waiting for acks after this long")
+    parser.add_argument("--keep", action="store_true",
+                        help="leave the retained discovery configs behind")
+    args = parser.parse_args()
+
+    install_host_modules()
+    monitor = SysMonitor(args.host, args.port)
+    monitor.start()
+
+    opts = {"host": args.host, "port": args.port, "rounds": args.rounds,
+            "interval": args.interval, "timeout": args.timeout}
+    procs = max(1, min(args.procs, args.nodes))
+    jobs = []
+    first = 0
+    for i in range(procs):
+        count = args.nodes // procs + (i < args.nodes % procs)
+        jobs.append((first, count, opts))
+        first += count
+
+    started = time.monotonic()
+    with multiprocessing.Pool(procs) as pool:
+        results = pool.map(run_nodes, jobs)
+    elapsed = time.monotonic() - started
+    monitor.stop()
+
+    connect = [t for r in results for t in r["connect"]]
+    span = (max(r["connect_end"] for r in results) -
+            min(r["connect_start"] for r in results))
+    print("{} nodes in {} processes, {:.1f}s".format(args.nodes, procs, elapsed))
+    print("  connect: {:.0f}/s, {}; {} failed".format(
+        len(connect) / span if span else 0, percentiles(connect),
+        sum(r["errors"] for r in results)))
+    print("  discovery per node:", percentiles(
+        [t for r in results for t in r["discovery"]]))
+    print("  QoS 1 ack:", percentiles([t for r in results for t in r["acks"]]),
+          "- {} unacknowledged".format(sum(r["lost"] for r in results)))
+    print("  client bytes sent: {:.0f} B/node".format(
+        sum(r["bytes"] for r in results) / max(1, len(connect))))
+    rates = monitor.rates()
+    if rates:
+        for name in sorted(rates):
+            print("  broker {}: {:.0f}/s".format(name, rates[name]))
+    else:
+        print("  broker: no $SYS samples (run longer than the broker's "
+              "sys_interval)")
+
+    if not args.keep:
+        for topic in sorted({t for r in results for t in r["config_topics"]}):
+            monitor.mqtt.publish(topic, b"", True)
+    monitor.mqtt.disconnect()
+
+
+if __name__ == "__main__":
+    main()
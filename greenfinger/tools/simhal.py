@@ -0,0 +1,717 @@
+"""
+Simulated hardware for running greenfinger on the host.
+
+install() puts stand-ins for the MicroPython modules the firmware imports
+(utime, machine, dht, network, framebuf, uasyncio, usocket, uselect, ujson)
+into sys.modules, so the unmodified device code runs under CPython. All of
+them share one World:
+
+- a virtual monotonic clock; sleeping advances it instantly, so months of
+  operation take seconds,
+- soil that dries over time and gets wet while its pump pin is high,
+  read back through the probe power pins and the shared ADC,
+- a DHT following a daily temperature cycle,
+- an I2C bus that counts the bytes sent to the display,
+- an in-memory MQTT broker answering the real umqttsimple client.
+
+When the clock passes World.end, the next sleep raises SimulationEnd.
+"""
+import builtins
+import gc
+import heapq
+import json
+import math
+import random
+import sys
+import types
+
+TICKS_PERIOD = 1 << 30
+# utime.time() at the start, seconds since the MicroPython 2000 epoch
+EPOCH = 700000000
+
+
+class Reset(BaseException):
+    "machine.deepsleep() ended; the firmware boots again"
+
+
+class SimulationEnd(BaseException):
+    "Raised from a sleep once the simulation is over; passes except Exception"
+    pass
+
+
+class Plant:
+    """
+    Soil around one probe and its pump. probe is the GPIO powering it on A0,
+    or ("mux", channel) / ("ads", channel) like in config ENTITIES.
+    """
+    def __init__(self, probe, pump_pin, moisture=30.0, dry_rate=0.25,
+                 pump_rate=1.5):
+        self.probe = probe
+        self.pump_pin = pump_pin
+        self.moisture = moisture  # %
+        self.dry_rate = dry_rate  # fraction of moisture lost per day at 20C
+        self.pump_rate = pump_rate  # % per second of pumping
+        self.pump_seconds = 0.0
+        self.waterings = 0
+        self.low = moisture
+        self.high = moisture
+
+    def step(self, world, dt):
+        temp = world.air_temp()
+        rate = self.dry_rate * max(0.2, 1 + (temp - 20) / 20) / 86400
+        self.moisture *= math.exp(-rate * dt)
+        if world.pins.get(self.pump_pin):
+            self.moisture = min(100.0, self.moisture + self.pump_rate * dt)
+            self.pump_seconds += dt
+        self.low = min(self.low, self.moisture)
+        self.high = max(self.high, self.moisture)
+
+
+class World:
+    PHYSICS_STEP = 10 * 1000000  # us
+
+    def __init__(self, plants=(), seed=0, end=None, noise=1.0, spikes=0.0,
+                 probe_power=None, mux_select=None):
+        self.random = random.Random(seed)
+        self.now_us = 0
+        self.physics_us = 0
+        self.end = end  # seconds
+        self.plants = list(plants)
+        self.pins = {}
+        self.noise = noise  # ADC counts
+        self.spikes = spikes  # probability of a bogus ADC reading
+        self.probe_power = probe_power  # excites all mux/ADS probes
+        self.mux_select = mux_select or ()
+        self.ads_channel = 0
+        self.i2c_bytes = 0
+        self.adc_reads = 0
+        self.pumps_peak = 0  # most pumps running at once
+        self.heap_free = 30000
+        self.asleep = 0.0  # seconds in light or deep sleep
+        self.reset_cause = 0
+        self.rtc_memory = b""
+        self.broker = Broker(self)
+        self.timers = []  # armed machine.Timer
+
+    @property
+    def now(self):
+        return self.now_us / 1e6
+
+    def advance(self, seconds):
+        if seconds <= 0:
+            return
+        if self.end is not None and self.now >= self.end:
+            raise SimulationEnd()
+        end_us = self.now_us + int(seconds * 1e6)
+        # Timer callbacks run at their time, whatever the firmware is doing
+        while self.timers:
+            timer = min(self.timers, key=lambda timer: timer.due_us)
+            if timer.due_us > end_us:
+                break
+            self.now_us = max(self.now_us, timer.due_us)
+            timer.fire()
+        self.now_us = end_us
+
+    def settle(self):
+        "Bring the soil up to the clock; pins are constant since the last call"
+        while self.physics_us < self.now_us:
+            step = min(self.now_us - self.physics_us, self.PHYSICS_STEP)
+            self.physics_us += step
+            for plant in self.plants:
+                plant.step(self, step / 1e6)
+
+    def air_temp(self):
+        return 20 + 5 * math.sin(2 * math.pi * self.now / 86400)
+
+    def air_humidity(self):
+        return 55 - 15 * math.sin(2 * math.pi * self.now / 86400)
+
+    def _noisy(self, value):
+        value += 5 + self.random.gauss(0, self.noise)
+        if self.spikes and self.random.random() < self.spikes:
+            value = self.random.choice((0, 1023))
+        return max(0, min(1023, int(value)))
+
+    def _bank(self, kind, channel):
+        "Reading of a mux/ADS probe; they are all excited by probe_power"
+        if self.pins.get(self.probe_power) != 1:
+            return 0
+        for plant in self.plants:
+            if plant.probe == (kind, channel):
+                return plant.moisture * 1023 / 100
+        return 0
+
+    def adc_read(self):
+        "A0: GPIO powered probes, plus the mux output if there is one"
+        self.adc_reads += 1
+        self.settle()
+        value = 0
+        for plant in self.plants:
+            if isinstance(plant.probe, int) and self.pins.get(plant.probe) == 1:
+                value += plant.moisture * 1023 / 100
+        if self.mux_select:
+            channel = 0
+            for i, pin in enumerate(self.mux_select):
+                channel |= (self.pins.get(pin) or 0) << i
+            value += self._bank("mux", channel)
+        return self._noisy(value)
+
+    def ads_write(self, reg, buf):
+        if reg == 1:
+            self.ads_channel = ((buf[0] >> 4) & 7) - 4
+
+    def ads_read(self, reg, buf):
+        "Conversion register, +-4.096 V full scale against 3.3 V probes"
+        self.adc_reads += 1
+        self.settle()
+        counts = self._noisy(self._bank("ads", self.ads_channel))
+        raw = counts * 32767 * 3300 // (4096 * 1023)
+        buf[0] = raw >> 8
+        buf[1] = raw & 0xff
+
+    def set_pin(self, pin, value):
+        self.settle()
+        for plant in self.plants:
+            if plant.pump_pin == pin and value and not self.pins.get(pin):
+                plant.waterings += 1
+        self.pins[pin] = value
+        running = sum(1 for plant in self.plants
+                      if self.pins.get(plant.pump_pin))
+        if running > self.pumps_peak:
+            self.pumps_peak = running
+
+
+class Broker:
+    "Just enough of an MQTT 3.1.1 broker for a single client"
+    def __init__(self, world):
+        self.world = world
+        self.down = False
+        # Half-open: the client's writes vanish and nothing comes back
+        self.silent = False
+        self.sock = None
+        self.inbox = bytearray()
+        self.bytes_in = 0
+        self.packets = 0
+        self.connects = 0
+        self.publishes = []  # (time, topic, payload)
+        self.subscriptions = set()
+        self.closes = []  # times the client closed its connection
+        # Keepalive of the client's CONNECT; silent for 1.5 times that and
+        # the broker drops the connection, as a real one does
+        self.keepalive = 0
+        self.last_seen = 0
+        self.expired = 0
+
+    def connect(self, sock):
+        if self.down:
+            raise OSError(111)
+        if self.silent:
+            raise OSError(113)
+        self.sock = sock
+        self.inbox = bytearray()
+        self.connects += 1
+        self.last_seen = self.world.now
+
+    def inject(self, topic, payload):
+        "Send a PUBLISH to the client, e.g. a command from Home Assistant"
+        topic = topic.encode() if isinstance(topic, str) else topic
+        body = len(topic).to_bytes(2, "big") + topic + payload
+        self.sock.inbound += b"\x30" + _varlen(len(body)) + body
+
+    def expire(self):
+        "Drop the connection if the client went quiet past its keepalive"
+        sock = self.sock
+        if (sock is not None and self.keepalive and not sock.dropped and
+                self.world.now - self.last_seen > 1.5 * self.keepalive):
+            sock.dropped = True
+            self.expired += 1
+
+    def receive(self, data):
+        if self.down:
+            raise OSError(104)
+        self.expire()
+        if self.sock.dropped:
+            raise OSError(104)
+        if self.silent:
+            return
+        self.last_seen = self.world.now
+        self.bytes_in += len(data)
+        self.inbox += data
+        while True:
+            packet = _split(self.inbox)
+            if packet is None:
+                return
+            self.packets += 1
+            self._handle(*packet)
+
+    def _handle(self, op, body):
+        kind = op >> 4
+        reply = self.sock.inbound
+        if kind == 1:  # CONNECT
+            # After the protocol name, level and flags
+            self.keepalive = body[8] << 8 | body[9]
+            reply += b"\x20\x02\x00\x00"
+        elif kind == 3:  # PUBLISH
+            pos = 2 + (body[0] << 8 | body[1])
+            topic = bytes(body[2:pos]).decode()
+            if op & 6:
+                reply += b"\x40\x02" + bytes(body[pos:pos + 2])
+                pos += 2
+            self.publishes.append((self.world.now, topic, bytes(body[pos:])))
+        elif kind == 8:  # SUBSCRIBE
+            pos = 2
+            while pos < len(body):
+                tlen = body[pos] << 8 | body[pos + 1]
+                self.subscriptions.add(bytes(body[pos + 2:pos + 2 + tlen]).decode())
+                pos += 3 + tlen
+            reply += b"\x90\x03" + bytes(body[0:2]) + b"\x00"
+        elif kind == 12:  # PINGREQ
+            reply += b"\xd0\x00"
+
+
+def _varlen(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        out.append(byte | (0x80 if value else 0))
+        if not value:
+            return bytes(out)
+
+
+def _split(buf):
+    "Remove and return the first complete packet in buf"
+    n = 0
+    shift = 0
+    pos = 1
+    while True:
+        if pos >= len(buf):
+            return None
+        byte = buf[pos]
+        n |= (byte & 0x7f) << shift
+        shift += 7
+        pos += 1
+        if not byte & 0x80:
+            break
+    if len(buf) < pos + n:
+        return None
+    op = buf[0]
+    body = bytes(buf[pos:pos + n])
+    del buf[:pos + n]
+    return op, body
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def _utime(world):
+    def ticks_ms():
+        return (world.now_us // 1000) % TICKS_PERIOD
+
+    def ticks_us():
+        return world.now_us % TICKS_PERIOD
+
+    def ticks_add(ticks, delta):
+        return (ticks + delta) % TICKS_PERIOD
+
+    def ticks_diff(end, start):
+        half = TICKS_PERIOD // 2
+        return ((end - start + half) % TICKS_PERIOD) - half
+
+    return _module(
+        "utime",
+        time=lambda: EPOCH + int(world.now),
+        # Late bound, simulate.py wraps advance() for outages
+        sleep=lambda seconds: world.advance(seconds),
+        sleep_ms=lambda ms: world.advance(ms / 1000),
+        sleep_us=lambda us: world.advance(us / 1e6),
+        ticks_ms=ticks_ms,
+        ticks_us=ticks_us,
+        ticks_add=ticks_add,
+        ticks_diff=ticks_diff,
+    )
+
+
+def _machine(world):
+    class Pin:
+        IN = 0
+        OUT = 1
+        OPEN_DRAIN = 2
+        PULL_UP = 1
+        PULL_DOWN = 2
+
+        def __init__(self, pin, mode=-1, pull=-1, value=None):
+            self.pin = pin
+            self.init(mode, pull, value)
+
+        def init(self, mode=-1, pull=-1, value=None):
+            if mode == self.IN:
+                world.set_pin(self.pin, None)
+            if value is not None:
+                world.set_pin(self.pin, int(bool(value)))
+
+        def value(self, value=None):
+            if value is None:
+                return world.pins.get(self.pin) or 0
+            world.set_pin(self.pin, int(bool(value)))
+
+        def on(self):
+            self.value(1)
+
+        def off(self):
+            self.value(0)
+
+    class Timer:
+        ONE_SHOT = 0
+        PERIODIC = 1
+
+        def __init__(self, id=-1):
+            self.due_us = 0
+            self.period_us = 0
+            self.mode = self.ONE_SHOT
+            self.callback = None
+
+        def init(self, mode=ONE_SHOT, period=-1, callback=None):
+            self.deinit()
+            self.mode = mode
+            self.period_us = max(0, period) * 1000
+            self.callback = callback
+            self.due_us = world.now_us + self.period_us
+            world.timers.append(self)
+
+        def deinit(self):
+            if self in world.timers:
+                world.timers.remove(self)
+
+        def fire(self):
+            self.deinit()
+            if self.mode == self.PERIODIC:
+                self.due_us += max(1, self.period_us)
+                world.timers.append(self)
+            if self.callback is not None:
+                self.callback(self)
+
+    class ADC:
+        def __init__(self, channel):
+            self.channel = channel
+
+        def read(self):
+            return world.adc_read()
+
+    class I2C:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def writeto(self, addr, buf):
+            world.i2c_bytes += 1 + len(buf)
+
+        def writevto(self, addr, bufs):
+            world.i2c_bytes += 1 + sum(len(buf) for buf in bufs)
+
+        def writeto_mem(self, addr, reg, buf):
+            world.i2c_bytes += 2 + len(buf)
+            world.ads_write(reg, buf)
+
+        def readfrom_mem_into(self, addr, reg, buf):
+            world.i2c_bytes += 2 + len(buf)
+            world.ads_read(reg, buf)
+
+    class RTC:
+        def memory(self, data=None):
+            if data is None:
+                return world.rtc_memory
+            world.rtc_memory = bytes(data)
+
+    def lightsleep(ms=0):
+        world.asleep += ms / 1000
+        world.advance(ms / 1000)
+
+    def deepsleep(ms=0):
+        world.asleep += ms / 1000
+        world.advance(ms / 1000)
+        world.pins.clear()
+        del world.timers[:]
+        world.reset_cause = 4
+        raise Reset()
+
+    return _module(
+        "machine",
+        Pin=Pin, ADC=ADC, I2C=I2C, Timer=Timer, SoftI2C=I2C, RTC=RTC,
+        PWRON_RESET=0, HARD_RESET=1, WDT_RESET=3, DEEPSLEEP_RESET=4,
+        SOFT_RESET=5,
+        reset_cause=lambda: world.reset_cause,
+        lightsleep=lightsleep,
+        deepsleep=deepsleep,
+        freq=lambda *args: 80000000,
+    )
+
+
+def _dht(world):
+    class DHT11:
+        def __init__(self, pin):
+            self.pin = pin
+
+        def measure(self):
+            world.advance(0.02)
+
+        def temperature(self):
+            return int(world.air_temp())
+
+        def humidity(self):
+            return int(world.air_humidity())
+
+    return _module("dht", DHT11=DHT11, DHT22=DHT11)
+
+
+def _network(world):
+    class WLAN:
+        def __init__(self, interface=0):
+            self._active = False
+
+        def active(self, value=None):
+            if value is None:
+                return self._active
+            self._active = value
+
+        def connect(self, *args):
+            pass
+
+        def disconnect(self):
+            pass
+
+        def isconnected(self):
+            return self._active
+
+    return _module("network", WLAN=WLAN, STA_IF=0, AP_IF=1)
+
+
+def _framebuf():
+    class FrameBuffer:
+        "Byte-per-column approximation; enough to drive partial updates"
+        def __init__(self, buf, width, height, fmt=0):
+            self.buf = buf
+            self.width = width
+            self.height = height
+
+        def fill(self, col):
+            self.buf[:] = bytes([0xff if col else 0]) * len(self.buf)
+
+        def fill_rect(self, x, y, w, h, col):
+            for page in range(y // 8, min((y + h + 7) // 8, self.height // 8)):
+                offset = page * self.width
+                for i in range(max(0, x), min(x + w, self.width)):
+                    self.buf[offset + i] = 0xff if col else 0
+
+        def pixel(self, x, y, col=None):
+            if not (0 <= x < self.width and 0 <= y < self.height):
+                return 0
+            idx = (y // 8) * self.width + x
+            if col is None:
+                return (self.buf[idx] >> (y & 7)) & 1
+            if col:
+                self.buf[idx] |= 1 << (y & 7)
+            else:
+                self.buf[idx] &= ~(1 << (y & 7)) & 0xff
+
+        def text(self, string, x, y, col=1):
+            offset = (y // 8) * self.width
+            for i, char in enumerate(string):
+                for j in range(8):
+                    column = x + i * 8 + j
+                    if 0 <= column < self.width:
+                        self.buf[offset + column] = (ord(char) * (j + 1)) & 0xff
+
+        def scroll(self, dx, dy):
+            pass
+
+    return _module("framebuf", FrameBuffer=FrameBuffer,
+                   FrameBuffer1=FrameBuffer, MONO_VLSB=0)
+
+
+def _usocket(world):
+    class Socket:
+        def __init__(self, *args):
+            self.inbound = bytearray()
+            self.closed = False
+            # Closed by the broker
+            self.dropped = False
+            self.timeout = None
+
+        def connect(self, addr):
+            if world.broker.silent:
+                # SYNs go unanswered until the timeout, or lwIP's own
+                world.advance(min(self.timeout or 75, 75))
+                raise OSError(110)
+            world.broker.connect(self)
+
+        def settimeout(self, timeout):
+            self.timeout = timeout
+
+        def write(self, buf, length=-1):
+            if isinstance(buf, str):
+                buf = buf.encode()
+            data = bytes(buf if length < 0 else memoryview(buf)[:length])
+            world.broker.receive(data)
+            return len(data)
+
+        def readinto(self, buf):
+            world.broker.expire()
+            n = min(len(buf), len(self.inbound))
+            if not n and (world.broker.down or self.dropped):
+                return 0
+            buf[:n] = self.inbound[:n]
+            del self.inbound[:n]
+            return n
+
+        def read(self, n):
+            data = bytes(self.inbound[:n])
+            del self.inbound[:n]
+            return data
+
+        def close(self):
+            if not self.closed:
+                world.broker.closes.append(world.now)
+            self.closed = True
+
+        def setblocking(self, flag):
+            pass
+
+    return _module("usocket", socket=Socket,
+                   getaddrinfo=lambda host, port, *args: [(2, 1, 0, "", (host, port))])
+
+
+def _uselect(world):
+    POLLIN = 1
+    POLLOUT = 4
+
+    class Poll:
+        def __init__(self):
+            self.registered = {}
+
+        def register(self, sock, mask=POLLIN | POLLOUT):
+            self.registered[id(sock)] = (sock, mask)
+
+        def unregister(self, sock):
+            self.registered.pop(id(sock), None)
+
+        def poll(self, timeout=-1):
+            world.broker.expire()
+            ready = []
+            for sock, mask in self.registered.values():
+                if mask & POLLOUT and not world.broker.down:
+                    ready.append((sock, POLLOUT))
+                elif mask & POLLIN and (sock.inbound or world.broker.down or
+                                        sock.dropped):
+                    ready.append((sock, POLLIN))
+            if not ready:
+                if timeout < 0:
+                    raise OSError(110)
+                world.advance(timeout / 1000)
+            return ready
+
+    return _module("uselect", poll=Poll, POLLIN=POLLIN, POLLOUT=POLLOUT)
+
+
+def _uasyncio(world):
+    "Cooperative scheduler running on the virtual clock"
+    class _Sleep:
+        def __init__(self, until):
+            self.until = until
+
+        def __await__(self):
+            yield self
+
+    class Task:
+        def __init__(self, coro):
+            self.coro = coro
+            self.done = False
+            self.result = None
+            self.waiters = []
+
+        def __await__(self):
+            if not self.done:
+                yield self
+            return self.result
+
+    class Loop:
+        def __init__(self):
+            self.queue = []
+            self.seq = 0
+
+        def schedule(self, task, at):
+            self.seq += 1
+            heapq.heappush(self.queue, (at, self.seq, task))
+
+        def run(self, main):
+            while not main.done:
+                at, _, task = heapq.heappop(self.queue)
+                world.advance((at - world.now_us) / 1e6)
+                try:
+                    request = task.coro.send(None)
+                except StopIteration as e:
+                    task.done = True
+                    task.result = e.value
+                    for waiter in task.waiters:
+                        self.schedule(waiter, world.now_us)
+                    continue
+                if isinstance(request, _Sleep):
+                    self.schedule(task, max(request.until, world.now_us))
+                elif isinstance(request, Task):
+                    request.waiters.append(task)
+                else:
+                    self.schedule(task, world.now_us)
+
+    loop = Loop()
+
+    async def sleep(seconds):
+        await _Sleep(world.now_us + int(seconds * 1e6))
+
+    async def sleep_ms(ms):
+        await _Sleep(world.now_us + int(ms * 1000))
+
+    def create_task(coro):
+        task = Task(coro)
+        loop.schedule(task, world.now_us)
+        return task
+
+    async def gather(*coros):
+        tasks = [create_task(coro) for coro in coros]
+        return [await task for task in tasks]
+
+    def run(coro):
+        main = create_task(coro)
+        loop.run(main)
+        return main.result
+
+    return _module("uasyncio", sleep=sleep, sleep_ms=sleep_ms,
+                   create_task=create_task, gather=gather, run=run)
+
+
+def _gc(world):
+    "Device heap calls; a full CPython collection per loop would dominate"
+    module = _module("gc", collect=lambda: None,
+                     mem_free=lambda: world.heap_free, mem_alloc=lambda: 0)
+    module.__getattr__ = lambda name: getattr(gc, name)
+    return module
+
+
+def install(world, config=None):
+    "Register the simulated modules; config is a dict for the config module"
+    builtins.const = lambda value: value
+    _utime(world)
+    _machine(world)
+    _dht(world)
+    _network(world)
+    _framebuf()
+    _usocket(world)
+    _uselect(world)
+    _uasyncio(world)
+    sys.modules["ujson"] = json
+    _gc(world)
+    if config is not None:
+        _module("config", **config)
+    return world
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Run the unmodified firmware against simulated hardware.
+
+Boots greenfinger.run() on top of tools/simhal.py with a virtual clock,
+so a month of watering decisions takes seconds. Reports what the plants
+went through, how long a loop iteration kept the CPU busy and how much
+went over I2C and MQTT.
+
+    python3 tools/simulate.py [-c config.py] [--days 7] [--async]
+                              [--outage HOURS:DURATION [--half-open]]
+                              [--spikes P]
+                              [--power light|deep]
+                              [--seed 0] [-v]
+
+simulate() returns the report as a dict, for scripted regression checks.
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time as host_time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+sys.path.insert(1, SRC)
+
+import simhal
+from discovery import entity_table
+from gen_ha_frozen import load_config
+
+# Starting moisture and drying rate of the pots, in turn
+POTS = ((12, 0.25), (30, 0.4), (20, 0.3), (25, 0.35))
+
+
+def plants_for(cfg):
+    "One simulated pot per entity of greenfinger.run()"
+    plants = []
+    for i, row in enumerate(entity_table(cfg)):
+        moisture, dry_rate = POTS[i % len(POTS)]
+        plants.append(simhal.Plant(row[1], row[2], moisture=moisture,
+                                   dry_rate=dry_rate))
+    return plants
+
+
+class LoopProbe:
+    "Measures the busy part of each GreenFinger.loop() iteration"
+    def __init__(self, world):
+        self.world = world
+        self.busy = []
+        self.resumed = None
+
+    def attach(self, gf_class):
+        world = self.world
+        wait = gf_class.wait
+        probe = self
+
+        def timed_wait(gf, seconds):
+            if probe.resumed is not None:
+                probe.busy.append(world.now - probe.resumed)
+            wait(gf, seconds)
+            probe.resumed = world.now
+        gf_class.wait = timed_wait
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def boot(world, probe):
+    "Import the firmware afresh, like after a reset, and run it"
+    for name in os.listdir(SRC):
+        if name.endswith(".py") and name != "config.py":
+            sys.modules.pop(name[:-3], None)
+    import ha_api
+    ha_api.FROZEN = {}
+    import greenfinger
+    probe.attach(greenfinger.GreenFinger)
+    probe.resumed = None
+    greenfinger.run(boot_ticks=0)
+
+
+def simulate(cfg, days=7, use_async=False, outage=None, seed=0, verbose=False,
+             spikes=0.0, power=None, half_open=False):
+    config = vars(cfg).copy()
+    config["ASYNC_RUNTIME"] = use_async
+    if power is not None:
+        config["POWER_MODE"] = power
+    world = simhal.World(plants_for(cfg), seed=seed, end=days * 86400,
+                         spikes=spikes,
+                         probe_power=getattr(cfg, "PROBE_POWER", None),
+                         mux_select=getattr(cfg, "PROBE_MUX_SELECT", None))
+    simhal.install(world, config)
+    sys.path.insert(0, SRC)
+
+    log = sys.stdout if verbose else io.StringIO()
+    probe = LoopProbe(world)
+    boots = 0
+    if outage:
+        start, duration = outage
+        broker = world.broker
+        advance = world.advance
+
+        def advance_with_outage(seconds):
+            advance(seconds)
+            out = start * 3600 <= world.now < (start + duration) * 3600
+            if half_open:
+                broker.silent = out
+            else:
+                broker.down = out
+        world.advance = advance_with_outage
+
+    started = host_time.monotonic()
+    cwd = os.getcwd()
+    # The firmware's files (flash log, queued messages) go to a scratch
+    # directory standing in for the flash filesystem
+    with tempfile.TemporaryDirectory() as flash:
+        os.chdir(flash)
+        try:
+            with contextlib.redirect_stdout(log):
+                while True:
+                    boots += 1
+                    try:
+                        boot(world, probe)
+                    except simhal.Reset:
+                        continue
+                    except simhal.SimulationEnd:
+                        break
+        finally:
+            os.chdir(cwd)
+        flash_bytes = sum(os.path.getsize(os.path.join(flash, name))
+                          for name in os.listdir(flash))
+    wall = host_time.monotonic() - started
+    world.settle()
+
+    broker = world.broker
+    noticed = None
+    if outage:
+        # Until the client gave up on the connection it had
+        closes = [t for t in broker.closes
+                  if start * 3600 <= t < (start + duration) * 3600]
+        if closes:
+            noticed = closes[0] - start * 3600
+    return {
+        "days": days,
+        "wall_seconds": wall,
+        "speedup": world.now / wall if wall else 0,
+        "plants": [{
+            "pump_pin": plant.pump_pin,
+            "waterings": plant.waterings,
+            "pump_seconds": plant.pump_seconds,
+            "moisture_min": plant.low,
+            "moisture_max": plant.high,
+            "moisture_end": plant.moisture,
+        } for plant in world.plants],
+        "pumps_peak": world.pumps_peak,
+        "boots": boots,
+        "awake": 1 - world.asleep / world.now,
+        "loop_iterations": len(probe.busy),
+        "loop_busy_p50": percentile(probe.busy, 0.5),
+        "loop_busy_max": max(probe.busy) if probe.busy else 0,
+        "i2c_bytes": world.i2c_bytes,
+        "flash_bytes": flash_bytes,
+        "adc_reads": world.adc_reads,
+        "mqtt_connects": broker.connects,
+        "mqtt_expired": broker.expired,
+        "mqtt_bytes": broker.bytes_in,
+        "mqtt_packets": broker.packets,
+        "mqtt_publishes": len(broker.publishes),
+        "outage_noticed": noticed,
+    }
+
+
+def print_report(report):
+    print("Simulated {days} days in {wall_seconds:.1f}s "
+          "({speedup:.0f}x)".format(**report))
+    for plant in report["plants"]:
+        print("  pump {pump_pin}: {waterings} waterings, {pump_seconds:.0f}s "
+              "pumping, moisture {moisture_min:.1f}..{moisture_max:.1f}% "
+              "(end {moisture_end:.1f}%)".format(**plant))
+    print("  at most {pumps_peak} pumps running at once".format(**report))
+    print("  {boots} boots, awake {awake:.1%} of the time".format(**report))
+    if report["loop_iterations"]:
+        print("  loop: {loop_iterations} iterations, busy p50 "
+              "{loop_busy_p50:.3f}s max {loop_busy_max:.3f}s".format(**report))
+    days = report["days"]
+    print("  I2C: {:.0f} B/day, ADC: {:.0f} reads/day".format(
+        report["i2c_bytes"] / days, report["adc_reads"] / days))
+    print("  flash: {} B in files".format(report["flash_bytes"]))
+    if report["outage_noticed"] is not None:
+        print("  outage noticed after {:.1f}s".format(report["outage_noticed"]))
+    print("  MQTT: {} connects, {:.0f} B/day in {:.0f} packets/day, "
+          "{:.0f} publishes/day".format(
+              report["mqtt_connects"], report["mqtt_bytes"] / days,
+              report["mqtt_packets"] / days, report["mqtt_publishes"] / days))
+    if report["mqtt_expired"]:
+        print("  MQTT: {mqtt_expired} connections dropped by the broker for "
+              "missed keepalives".format(**report))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("-c", "--config",
+                        default=os.path.join(SRC, "config.py"),
+                        help="config to simulate (default: config.py, "
+                             "falling back to config_tmpl.py)")
+    parser.add_argument("--days", type=float, default=7)
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run the uasyncio runtime")
+    parser.add_argument("--outage", metavar="HOURS:DURATION",
+                        help="take the broker down at HOURS for DURATION hours")
+    parser.add_argument("--half-open", action="store_true",
+                        help="the outage leaves the connection half-open "
+                             "instead of refusing it")
+    parser.add_argument("--power", choices=("light", "deep"),
+                        help="override POWER_MODE")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--spikes", type=float, default=0.0,
+                        help="probability of a bogus ADC reading")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="show the firmware's console output")
+    args = parser.parse_args()
+
+    path = args.config
+    if not os.path.exists(path):
+        path = os.path.join(SRC, "config_tmpl.py")
+    outage = None
+    if args.outage:
+        outage = tuple(float(part) for part in args.outage.split(":"))
+    report = simulate(load_config(path), args.days, args.use_async, outage,
+                      args.seed, args.verbose, args.spikes, args.power,
+                      args.half_open)
+    print_report(report)
+
+
+if __name__ == "__main__":
+    main()
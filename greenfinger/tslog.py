@@ -0,0 +1,252 @@
+"""
+Append-only time series log on flash.
+
+Fixed-width records go to a ring of segment files, oldest overwritten
+first. Records are buffered in RAM and written in batches, and a segment
+is created (truncated) only when the previous one is full, so the flash
+sees few, sequential writes spread over all segments. Each segment
+starts with a header carrying its sequence number; the index of the
+segments (sequence, first and last timestamp, record count) is rebuilt
+from the files at boot and kept in RAM.
+
+Record: "<IBBhhh" = timestamp (device time.time()), entity index (NODE
+for the node itself), kind, value, air temperature and humidity; value,
+temperature and humidity in tenths, MISSING if unknown. Value is the
+moisture % of a triage window for MOISTURE and the watering seconds for
+WATER. A BOOT record marks a reset, after which the clock may have
+jumped.
+
+Queries stream matching records in chunks through one small buffer:
+
+    cursor = log.query(start, end)
+    while True:
+        chunk = cursor.read()  # memoryview of whole records, or None
+        ...
+"""
+import struct
+from array import array
+
+MAGIC = b"GFL1"
+HEADER = "<4sI"
+HEADER_SIZE = struct.calcsize(HEADER)
+RECORD = "<IBBhhh"
+RECORD_SIZE = struct.calcsize(RECORD)
+
+# Record kinds
+MOISTURE = 0
+WATER = 1
+BOOT = 2
+KINDS = ("moisture", "water", "boot")
+
+NODE = 255
+MISSING = -32768
+
+# Queries go to TOPIC/query, chunks come back on TOPIC/data
+TOPIC = "greenfinger/{}/log"
+# Chunk header: chunk number, record count; no records ends the stream
+CHUNK = "<HH"
+
+
+def _tenths(value):
+    return MISSING if value is None else int(round(value * 10))
+
+
+class TSLog:
+    def __init__(self, prefix="tslog", segments=8, segment_records=512,
+                 buffer_records=16):
+        self.prefix = prefix
+        self.segment_records = segment_records
+        # Index of the segments, by file number
+        self.seqs = array("i", [-1] * segments)
+        self.counts = array("i", [0] * segments)
+        self.firsts = array("I", [0] * segments)
+        self.lasts = array("I", [0] * segments)
+        self.current = 0
+        self.buf = bytearray(RECORD_SIZE * buffer_records)
+        self.pending = 0
+        self.written = 0
+        # Records lost to flash errors
+        self.dropped = 0
+        self._scan()
+
+    def path(self, segment):
+        return "{}{}.bin".format(self.prefix, segment)
+
+    def _scan(self):
+        "Rebuild the index from the segment files"
+        record = bytearray(RECORD_SIZE)
+        newest = -1
+        torn = False
+        for i in range(len(self.seqs)):
+            try:
+                f = open(self.path(i), "rb")
+            except OSError:
+                continue
+            with f:
+                header = f.read(HEADER_SIZE)
+                if len(header) < HEADER_SIZE:
+                    continue
+                magic, seq = struct.unpack(HEADER, header)
+                if magic != MAGIC:
+                    continue
+                size = f.seek(0, 2) - HEADER_SIZE
+                count = size // RECORD_SIZE
+                self.seqs[i] = seq
+                self.counts[i] = count
+                if count:
+                    f.seek(HEADER_SIZE)
+                    f.readinto(record)
+                    self.firsts[i] = struct.unpack_from(RECORD, record)[0]
+                    f.seek(HEADER_SIZE + (count - 1) * RECORD_SIZE)
+                    f.readinto(record)
+                    self.lasts[i] = struct.unpack_from(RECORD, record)[0]
+                if seq > newest:
+                    newest = seq
+                    self.current = i
+                    # A write cut short by a reset leaves part of a record
+                    torn = size % RECORD_SIZE != 0
+        if (newest < 0 or torn or
+                self.counts[self.current] >= self.segment_records):
+            self._rotate()
+
+    def _rotate(self):
+        "Start the next segment, overwriting the oldest"
+        seq = self.seqs[self.current] + 1
+        current = self.current
+        if self.seqs[current] >= 0:
+            current = (current + 1) % len(self.seqs)
+        with open(self.path(current), "wb") as f:
+            f.write(struct.pack(HEADER, MAGIC, seq))
+        self.current = current
+        self.seqs[current] = seq
+        self.counts[current] = 0
+
+    def append(self, ts, entity, kind, value=None, temp=None, humid=None):
+        "Buffer a record; written once the buffer is full or on flush()"
+        struct.pack_into(RECORD, self.buf, self.pending * RECORD_SIZE,
+                         ts, entity, kind, _tenths(value), _tenths(temp),
+                         _tenths(humid))
+        self.pending += 1
+        if self.pending * RECORD_SIZE >= len(self.buf):
+            self.flush()
+
+    def flush(self):
+        "Write the buffered records; on a flash error they are dropped"
+        self.written = 0
+        try:
+            self._write()
+        except OSError as e:
+            # A full or failing flash costs the batch, not the control loop
+            print("Log write failed", e)
+            self.dropped += self.pending - self.written
+            # The segment may end in part of a record; go on in the next one
+            self.counts[self.current] = self.segment_records
+        self.pending = 0
+
+    def _write(self):
+        buf = memoryview(self.buf)
+        while self.written < self.pending:
+            if self.counts[self.current] >= self.segment_records:
+                self._rotate()
+            written = self.written
+            current = self.current
+            room = self.segment_records - self.counts[current]
+            n = self.pending - written
+            if n > room:
+                n = room
+            with open(self.path(current), "ab") as f:
+                f.write(buf[written * RECORD_SIZE:(written + n) * RECORD_SIZE])
+            if not self.counts[current]:
+                self.firsts[current] = struct.unpack_from(
+                    RECORD, buf, written * RECORD_SIZE)[0]
+            self.lasts[current] = struct.unpack_from(
+                RECORD, buf, (written + n - 1) * RECORD_SIZE)[0]
+            self.counts[current] += n
+            self.written = written + n
+
+    def segments(self, start, end):
+        "Segments which may hold records of start..end, oldest first"
+        found = []
+        for i in range(len(self.seqs)):
+            if (self.seqs[i] >= 0 and self.counts[i] and
+                    self.firsts[i] <= end and self.lasts[i] >= start):
+                found.append(i)
+        found.sort(key=lambda i: self.seqs[i])
+        return found
+
+    def query(self, start=0, end=0xffffffff, chunk=32):
+        self.flush()
+        return Cursor(self, start, end, chunk)
+
+
+class Cursor:
+    "Records of start..end, read segment by segment into a fixed buffer"
+    def __init__(self, log, start, end, chunk=32):
+        self.log = log
+        self.start = start
+        self.end = end
+        self.todo = log.segments(start, end)
+        self.seq = log.seqs[self.todo[0]] if self.todo else -1
+        self.offset = HEADER_SIZE
+        self.buf = bytearray(RECORD_SIZE * chunk)
+        self.sent = 0
+
+    def _next_segment(self):
+        self.todo.pop(0)
+        self.offset = HEADER_SIZE
+        if self.todo:
+            self.seq = self.log.seqs[self.todo[0]]
+
+    def read(self):
+        "Next matching records, a memoryview into the buffer; None at the end"
+        buf = memoryview(self.buf)
+        log = self.log
+        while self.todo:
+            segment = self.todo[0]
+            if log.seqs[segment] != self.seq:
+                # Overwritten since the query started
+                self._next_segment()
+                continue
+            with open(log.path(segment), "rb") as f:
+                f.seek(self.offset)
+                size = f.readinto(self.buf)
+            size -= size % RECORD_SIZE
+            if not size:
+                self._next_segment()
+                continue
+            self.offset += size
+            # Keep the matching records, packed at the front of the buffer
+            kept = 0
+            n = RECORD_SIZE
+            for pos in range(0, size, n):
+                ts = struct.unpack_from("<I", buf, pos)[0]
+                if self.start <= ts <= self.end:
+                    if pos != kept:
+                        buf[kept:kept + n] = buf[pos:pos + n]
+                    kept += n
+            if kept:
+                self.sent += kept // RECORD_SIZE
+                return buf[:kept]
+        return None
+
+
+def records(chunk):
+    "Decode a chunk of records into tuples"
+    for pos in range(0, len(chunk), RECORD_SIZE):
+        yield struct.unpack_from(RECORD, chunk, pos)
+
+
+def dump(log, start=0, end=0xffffffff):
+    "Print records of start..end as CSV, e.g. from the serial REPL"
+    print("ts,entity,kind,value,temp,humid")
+    cursor = log.query(start, end)
+    while True:
+        chunk = cursor.read()
+        if chunk is None:
+            return
+        for ts, entity, kind, value, temp, humid in records(chunk):
+            print("{},{},{},{},{},{}".format(
+                ts, entity, KINDS[kind] if kind < len(KINDS) else kind,
+                "" if value == MISSING else value / 10,
+                "" if temp == MISSING else temp / 10,
+                "" if humid == MISSING else humid / 10))
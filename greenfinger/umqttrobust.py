@@ -1,20 +1,132 @@
 # Source: https://github.com/micropython/micropython-lib
-from umqttsimple import MQTTClient as NotSoRobust
+from umqttsimple import MQTTClient as NotSoRobust, MQTTException
 import utime
 
+
+class OfflineQueue:
+    "Fixed-size ring of messages waiting for the broker"
+    DROP_OLDEST = 0
+    COALESCE = 1  # Keep only the newest message per topic
+
+    def __init__(self, size, policy=DROP_OLDEST):
+        # Slots are [topic, msg, retain, qos] lists, reused once allocated
+        self.slots = [None] * size
+        self.policy = policy
+        self.head = 0
+        self.count = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.count
+
+    def put(self, topic, msg, retain, qos):
+        size = len(self.slots)
+        if self.policy == self.COALESCE:
+            for i in range(self.count):
+                slot = self.slots[(self.head + i) % size]
+                if slot[0] == topic:
+                    slot[1] = msg
+                    slot[2] = retain
+                    slot[3] = qos
+                    return
+        if self.count == size:
+            self.pop()
+            self.dropped += 1
+        idx = (self.head + self.count) % size
+        slot = self.slots[idx]
+        if slot is None:
+            self.slots[idx] = [topic, msg, retain, qos]
+        else:
+            slot[0] = topic
+            slot[1] = msg
+            slot[2] = retain
+            slot[3] = qos
+        self.count += 1
+
+    def peek(self):
+        return self.slots[self.head]
+
+    def pop(self):
+        slot = self.slots[self.head]
+        slot[1] = None  # Release the payload
+        self.head = (self.head + 1) % len(self.slots)
+        self.count -= 1
+
+
 class MQTTClient(NotSoRobust):
     DELAY = 2
+    MAX_DELAY = 5 * 60
     DEBUG = True
 
+    def __init__(self, *args, queue_size=0, queue_policy=OfflineQueue.DROP_OLDEST,
+                 connect_timeout=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        # With a queue the client never blocks on a dead broker: publishes
+        # are queued and service() reconnects with a backoff.
+        self.queue = OfflineQueue(queue_size, queue_policy) if queue_size else None
+        self.connected = False
+        self.delay = self.DELAY
+        self.retry_at = utime.ticks_ms()
+        self.subs = {}  # topic -> qos, restored on reconnect
+        # Bounds the stall of a reconnect from service() on a dead network
+        self.connect_timeout = connect_timeout
+        # For the next connect; False resumes the session once there's one
+        self.clean_session = False
+
+    def _close(self):
+        if self.sock:
+            try:
+                self.poller_r.unregister(self.sock)
+                self.poller_w.unregister(self.sock)
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+        self.connected = False
+
+    def _lost(self, e):
+        "Connection failed; schedule the next attempt"
+        print("MQTT lost, retry in", self.delay, e)
+        self._close()
+        self.retry_at = utime.ticks_add(utime.ticks_ms(), self.delay * 1000)
+        self.delay = min(self.delay * 2, self.MAX_DELAY)
+
+    def connect(self, clean_session=True, timeout=None):
+        ret = super().connect(clean_session, timeout)
+        self.connected = True
+        self.clean_session = False
+        self.delay = self.DELAY
+        if not ret:
+            # No session on the broker, subscriptions are gone
+            for topic, qos in self.subs.items():
+                super().subscribe(topic, qos)
+        return ret
+
+    def start(self, clean_session=True):
+        "Initial connect; in non-blocking mode a failure is retried by service()"
+        self.clean_session = clean_session
+        if self.queue is None:
+            return self.connect(clean_session)
+        try:
+            return self.connect(clean_session)
+        except Exception as e:
+            self._lost(e)
+
+    def disconnect(self):
+        "Clean disconnect; service() or reconnect() connects again"
+        try:
+            super().disconnect()
+        except Exception:
+            pass
+        self._close()
+        self.retry_at = utime.ticks_ms()
+
     def reconnect(self):
         i = 0
         while 1:
             try:
-                if self.sock:
-                    self.poller_r.unregister(self.sock)
-                    self.poller_w.unregister(self.sock)
-                    self.sock.close()
-                return super().connect(False)
+                self._close()
+                return self.connect(False)
             except OSError as e:
                 print("Reconnect", i, e)
                 i += 1
@@ -22,8 +134,48 @@ class MQTTClient(NotSoRobust):
             except Exception as e:
                 print("OTHER ERROR", e)
 
+    def service(self):
+        "Advance the reconnect state machine and drain the queue. Never sleeps."
+        if self.queue is None:
+            return self.connected
+        if not self.connected:
+            if utime.ticks_diff(self.retry_at, utime.ticks_ms()) > 0:
+                return False
+            try:
+                self._close()
+                self.connect(self.clean_session, self.connect_timeout)
+            except Exception as e:
+                self._lost(e)
+                return False
+        try:
+            self.keep_alive()
+        except Exception as e:
+            self._lost(e)
+            return False
+        queue = self.queue
+        while len(queue):
+            slot = queue.peek()
+            try:
+                super().publish(slot[0], slot[1], slot[2], slot[3])
+            except Exception as e:
+                if self.connected:
+                    self._lost(e)
+                return False
+            queue.pop()
+        return True
 
     def publish(self, topic, msg, retain=False, qos=0):
+        if self.queue is not None:
+            if self.connected and not len(self.queue):
+                try:
+                    return super().publish(topic, msg, retain, qos)
+                except Exception as e:
+                    # Unless already lost while waiting for an ack
+                    if self.connected:
+                        self._lost(e)
+            self.queue.put(topic, msg, retain, qos)
+            return None
+
         while 1:
             try:
                 return super().publish(topic, msg, retain, qos)
@@ -33,6 +185,36 @@ class MQTTClient(NotSoRobust):
                 print("OTHER ERROR", e)
             self.reconnect()
 
+    def subscribe(self, topic, qos=0):
+        self.subs[topic] = qos
+        if self.queue is None:
+            return super().subscribe(topic, qos)
+        if not self.connected:
+            # Sent by connect() once the broker is back
+            return None
+        try:
+            return super().subscribe(topic, qos)
+        except Exception as e:
+            self._lost(e)
+
+    def check_msg(self):
+        if self.queue is None:
+            try:
+                return super().check_msg()
+            except MQTTException as e:
+                if e.args[0] != 31:
+                    raise
+                print("Keepalive missed")
+            self.reconnect()
+            return None
+        if not self.connected:
+            return None
+        try:
+            return super().check_msg()
+        except Exception as e:
+            self._lost(e)
+            return None
+
     def wait_msg(self):
         while 1:
             try:
@@ -17,8 +17,16 @@ def pid_gen(pid=0):
 
 
 class MQTTClient:
+    # Initial size of the receive buffer, grown for larger packets up to
+    # max_packet bytes
+    RBUF_SIZE = 128
+    # Initial size of the transmit buffer for PUBLISH packets
+    WBUF_SIZE = 128
+
     def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0,
-                 ssl=False, ssl_params=None, socket_timeout=5, message_timeout=10):
+                 ssl=False, ssl_params=None, socket_timeout=5, message_timeout=10,
+                 max_inflight=8, max_retries=3, ping_timeout=5,
+                 max_packet=1024):
         if port == 0:
             port = 8883 if ssl else 1883
         self.client_id = client_id
@@ -40,28 +48,60 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
-        self.rcv_pids = {}  # PUBACK and SUBACK pids awaiting ACK response
+        self.rcv_pids = {}  # SUBACK pids awaiting ACK response
+        # QoS 1 PUBLISHes awaiting PUBACK: pid -> [deadline, packet, retries]
+        self.inflight = {}
+        self.max_inflight = max_inflight
+        self.max_retries = max_retries
 
         self.last_ping = ticks_ms()  # Time of the last PING sent
         self.last_cpacket = ticks_ms()  # Time of last Control Packet
+        self.last_sent = ticks_ms()  # Time of the last write
+        # A PINGREQ was sent and nothing came back yet
+        self.ping_pending = False
+        self.ping_timeout = ping_timeout
 
         self.socket_timeout = socket_timeout
         self.message_timeout = message_timeout
 
-    def _read(self, n):
-        # in non-blocking mode, may not download enough data
+        # Larger incoming packets are read in pieces and dropped
+        self.max_packet = max_packet
+        self.rbuf = bytearray(self.RBUF_SIZE)
+        self.rview = memoryview(self.rbuf)
+        self.wbuf = bytearray(self.WBUF_SIZE)
+        self.topics = {}  # Length-prefixed encodings of registered topics
+
+    def _deadline(self):
+        "Deadline for receiving a whole packet"
+        if self.socket_timeout is None:
+            return None
+        return ticks_add(ticks_ms(), int(self.socket_timeout * 1000))
+
+    def _read_into(self, start, n, deadline):
+        "Read exactly n bytes into rbuf[start:], polling until the deadline"
+        end = start + n
+        if end > len(self.rbuf):
+            buf = bytearray(end)
+            buf[:start] = self.rview[:start]
+            self.rbuf = buf
+            self.rview = memoryview(buf)
         try:
-            msg = b''
-            for i in range(n):
-                self._sock_timeout(self.poller_r, self.socket_timeout)
-                msg += self.sock.read(1)
+            while start < end:
+                if deadline is None:
+                    timeout = -1
+                else:
+                    timeout = max(0, ticks_diff(deadline, ticks_ms()))
+                if not self.poller_r.poll(timeout):
+                    raise MQTTException(30)
+                got = self.sock.readinto(self.rview[start:end])
+                if got is None:
+                    continue
+                if not got:  # Connection closed by host (?)
+                    raise MQTTException(1)
+                start += got
         except AttributeError:
             raise MQTTException(8)
-        if msg == b'':  # Connection closed by host (?)
-            raise MQTTException(1)
-        if len(msg) != n:
-            raise MQTTException(2)
-        return msg
+        return end
 
     def _write(self, bytes_wr, length=-1):
         # In non-blocking socket mode, the entire block of data may not be sent.
@@ -70,6 +110,7 @@ class MQTTClient:
             out = self.sock.write(bytes_wr, length)
         except AttributeError:
             raise MQTTException(8)
+        self.last_sent = ticks_ms()
         if length < 0:
             if out != len(bytes_wr):
                 raise MQTTException(3)
@@ -83,15 +124,39 @@ class MQTTClient:
         self._write(len(s).to_bytes(2, 'big'))
         self._write(s)
 
-    def _recv_len(self):
+    def _recv_len(self, deadline):
         n = 0
         sh = 0
         while 1:
-            b = self._read(1)[0]
+            self._read_into(0, 1, deadline)
+            b = self.rbuf[0]
             n |= (b & 0x7f) << sh
             if not b & 0x80:
                 return n
             sh += 7
+            if sh > 21:
+                raise MQTTException(-1)
+
+    def _drop(self, op, sz, deadline):
+        """
+        Read and drop a packet over max_packet bytes without growing rbuf;
+        a QoS 1 PUBLISH is still acknowledged, or the broker resends it
+        """
+        pid = None
+        n = min(sz, len(self.rbuf))
+        self._read_into(0, n, deadline)
+        if op & 0xf0 == 0x30 and op & 6 == 2:
+            pos = 2 + (self.rbuf[0] << 8 | self.rbuf[1])
+            if pos + 2 <= n:
+                pid = self.rbuf[pos] << 8 | self.rbuf[pos + 1]
+        left = sz - n
+        while left:
+            n = min(left, len(self.rbuf))
+            self._read_into(0, n, deadline)
+            left -= n
+        if pid is not None:
+            self._write(b"\x40\x02")
+            self._write(pid.to_bytes(2, 'big'))
 
     def _varlen_encode(self, value, buf, offset=0):
         assert value < 268435456
@@ -116,14 +181,19 @@ class MQTTClient:
     def set_callback_status(self, f):
         self.cbstat = f
 
-    def connect(self, clean_session=True):
+    def connect(self, clean_session=True, timeout=None):
+        "timeout: seconds for the TCP connect and the CONNACK each"
+        if timeout is None:
+            timeout = self.socket_timeout
         self.sock = socket.socket()
         self.poller_r = uselect.poll()
         self.poller_r.register(self.sock, uselect.POLLIN)
         self.poller_w = uselect.poll()
         self.poller_w.register(self.sock, uselect.POLLOUT)
         addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+        self.sock.settimeout(timeout)
         self.sock.connect(addr)
+        self.sock.settimeout(None)
         if self.ssl:
             import ussl
             self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
@@ -137,6 +207,7 @@ class MQTTClient:
         # Clean session = True, remove current session
         if bool(clean_session):
             self.rcv_pids.clear()
+            self.inflight.clear()
         if self.user is not None:
             sz += 2 + len(self.user)
             msg[7] |= 1 << 7  # User Name Flag
@@ -163,7 +234,11 @@ class MQTTClient:
             self._send_str(self.user)
             if self.pswd is not None:
                 self._send_str(self.pswd)
-        resp = self._read(4)
+        deadline = None
+        if timeout is not None:
+            deadline = ticks_add(ticks_ms(), int(timeout * 1000))
+        self._read_into(0, 4, deadline)
+        resp = self.rbuf
         if not (resp[0] == 0x20 and resp[1] == 0x02):
             raise MQTTException(29)
         if resp[3] != 0:
@@ -172,7 +247,12 @@ class MQTTClient:
             else:
                 raise MQTTException(20, resp[3])
         self.last_cpacket = ticks_ms()
-        return resp[2] & 1
+        self.ping_pending = False
+        session_present = resp[2] & 1
+        # Unacknowledged messages are delivered again over the new connection
+        for entry in self.inflight.values():
+            self._resend(entry)
+        return session_present
 
     def disconnect(self):
         self._write(b"\xe0\0")
@@ -185,25 +265,93 @@ class MQTTClient:
     def ping(self):
         self._write(b"\xc0\0")
         self.last_ping = ticks_ms()
+        self.ping_pending = True
+
+    def keep_alive(self):
+        """
+        Ping once the link has been quiet either way for half the
+        keepalive period; raise MQTTException(31) if nothing came back
+        within ping_timeout seconds, so a half-open connection is
+        noticed before a write stalls on it. Called by check_msg().
+        """
+        if not self.keepalive or not self.sock:
+            return
+        now = ticks_ms()
+        if self.ping_pending:
+            if ticks_diff(now, self.last_ping) >= self.ping_timeout * 1000:
+                raise MQTTException(31)
+            return
+        idle = self.keepalive * 500
+        if (ticks_diff(now, self.last_cpacket) >= idle or
+                ticks_diff(now, self.last_sent) >= idle):
+            self.ping()
+
+    def register_topic(self, topic):
+        "Cache the wire encoding of a topic that is published often"
+        enc = topic.encode() if isinstance(topic, str) else bytes(topic)
+        assert len(enc) < 65536
+        self.topics[topic] = len(enc).to_bytes(2, 'big') + enc
 
     def publish(self, topic, msg, retain=False, qos=0, dup=False):
         assert qos in (0, 1)
-        pkt = bytearray(b"\x30\0\0\0\0")
-        pkt[0] |= qos << 1 | retain | int(dup) << 3
-        sz = 2 + len(topic) + len(msg)
+        enc = self.topics.get(topic)
+        if enc is None:
+            if isinstance(topic, str):
+                topic = topic.encode()
+            assert len(topic) < 65536
+            tlen = 2 + len(topic)
+        else:
+            tlen = len(enc)
+        if isinstance(msg, str):
+            msg = msg.encode()
+        sz = tlen + len(msg)
         if qos > 0:
             sz += 2
-        plen = self._varlen_encode(sz, pkt, 1)
-        self._write(pkt, plen)
-        self._send_str(topic)
+            self._wait_window()
+
+        # Build the whole packet in the transmit buffer and send it at once
+        if 5 + sz > len(self.wbuf):
+            self.wbuf = bytearray(5 + sz)
+        pkt = self.wbuf
+        pkt[0] = 0x30 | qos << 1 | retain | int(dup) << 3
+        pos = self._varlen_encode(sz, pkt, 1)
+        if enc is None:
+            pkt[pos] = len(topic) >> 8
+            pkt[pos + 1] = len(topic) & 0xff
+            pkt[pos + 2:pos + tlen] = topic
+        else:
+            pkt[pos:pos + tlen] = enc
+        pos += tlen
         if qos > 0:
             pid = next(self.newpid)
-            self._write(pid.to_bytes(2, 'big'))
-        self._write(msg)
+            pkt[pos] = pid >> 8
+            pkt[pos + 1] = pid & 0xff
+            pos += 2
+        pkt[pos:pos + len(msg)] = msg
+        pos += len(msg)
+        self._write(pkt, pos)
         if qos > 0:
-            self.rcv_pids[pid] = ticks_add(ticks_ms(), self.message_timeout * 1000)
+            self.inflight[pid] = [ticks_add(ticks_ms(), self.message_timeout * 1000),
+                                  pkt[:pos], 0]
             return pid
 
+    def _wait_window(self):
+        "Apply backpressure: service the socket until an in-flight slot frees"
+        deadline = self._deadline()
+        while len(self.inflight) >= self.max_inflight:
+            if deadline is not None and ticks_diff(deadline, ticks_ms()) <= 0:
+                raise MQTTException(30)
+            self.check_msg()
+            if self.sock is None:
+                # Closed meanwhile, e.g. by umqttrobust on an error
+                raise MQTTException(1)
+
+    def _resend(self, entry):
+        pkt = entry[1]
+        pkt[0] |= 0x08  # DUP
+        self._write(pkt)
+        entry[0] = ticks_add(ticks_ms(), self.message_timeout * 1000)
+
     def subscribe(self, topic, qos=0):
         assert qos in (0, 1)
         assert self.cb is not None, "Subscribe callback is not set"
@@ -220,21 +368,37 @@ class MQTTClient:
 
     def _message_timeout(self):
         curr_tick = ticks_ms()
+        expired = None
         for pid, timeout in self.rcv_pids.items():
             if ticks_diff(timeout, curr_tick) <= 0:
-                self.rcv_pids.pop(pid)
+                expired = expired or []
+                expired.append(pid)
+        for pid, entry in self.inflight.items():
+            if ticks_diff(entry[0], curr_tick) > 0:
+                continue
+            if entry[2] < self.max_retries:
+                entry[2] += 1
+                self._resend(entry)
+            else:
+                expired = expired or []
+                expired.append(pid)
+        if expired:
+            for pid in expired:
+                if pid in self.rcv_pids:
+                    self.rcv_pids.pop(pid)
+                else:
+                    self.inflight.pop(pid)
                 self.cbstat(pid, 0)
 
     def check_msg(self):
         if self.sock:
+            self.keep_alive()
             if not self.poller_r.poll(-1 if self.socket_timeout is None else 1):
                 self._message_timeout()
                 return None
+            deadline = self._deadline()
             try:
-                res = self._read(1)
-                if not res:
-                    self._message_timeout()
-                    return None
+                self._read_into(0, 1, deadline)
             except OSError as e:
                 if e.args[0] == 110:
                     self._message_timeout()
@@ -243,36 +407,45 @@ class MQTTClient:
                     raise e
         else:
             raise MQTTException(28)
-
-        if res == b"\xd0":
-            if self._read(1)[0] != 0:
-                MQTTException(-1)
+        # Anything from the broker shows the link is alive
+        self.ping_pending = False
+
+        # Read the whole packet into the receive buffer and parse it there
+        op = self.rbuf[0]
+        sz = self._recv_len(deadline)
+        if sz > self.max_packet:
+            self._drop(op, sz, deadline)
+            self._message_timeout()
+            return None
+        if sz:
+            self._read_into(0, sz, deadline)
+        buf = self.rbuf
+
+        if op == 0xd0:
+            if sz != 0:
+                raise MQTTException(-1)
             self.last_cpacket = ticks_ms()
             return
 
-        op = res[0]
-
         if op == 0x40:
-            sz = self._read(1)
-            if sz != b"\x02":
+            if sz != 2:
                 raise MQTTException(-1)
-            rcv_pid = int.from_bytes(self._read(2), 'big')
-            if rcv_pid in self.rcv_pids:
+            rcv_pid = buf[0] << 8 | buf[1]
+            if rcv_pid in self.inflight:
                 self.last_cpacket = ticks_ms()
-                self.rcv_pids.pop(rcv_pid)
+                self.inflight.pop(rcv_pid)
                 self.cbstat(rcv_pid, 1)
             else:
                 self.cbstat(rcv_pid, 2)
 
         if op == 0x90:
-            resp = self._read(4)
-            if resp[0] != 0x03:
-                raise MQTTException(40, resp)
-            if resp[3] == 0x80:
+            if sz != 3:
+                raise MQTTException(40, bytes(buf[:sz]))
+            if buf[2] == 0x80:
                 raise MQTTException(44)
-            if resp[3] not in (0, 1, 2):
-                raise MQTTException(40, resp)
-            pid = resp[2] | (resp[1] << 8)
+            if buf[2] not in (0, 1, 2):
+                raise MQTTException(40, bytes(buf[:sz]))
+            pid = buf[1] | (buf[0] << 8)
             if pid in self.rcv_pids:
                 self.last_cpacket = ticks_ms()
                 self.rcv_pids.pop(pid)
@@ -284,14 +457,12 @@ class MQTTClient:
 
         if op & 0xf0 != 0x30:
             return op
-        sz = self._recv_len()
-        topic_len = int.from_bytes(self._read(2), 'big')
-        topic = self._read(topic_len)
-        sz -= topic_len + 2
+        pos = 2 + (buf[0] << 8 | buf[1])
+        topic = bytes(self.rview[2:pos])
         if op & 6:  # QoS level > 0
-            pid = int.from_bytes(self._read(2), 'big')
-            sz -= 2
-        msg = self._read(sz) if sz else b''
+            pid = buf[pos] << 8 | buf[pos + 1]
+            pos += 2
+        msg = bytes(self.rview[pos:sz])
         retained = op & 0x01
         dup = op & 0x08
         self.cb(topic, msg, bool(retained), bool(dup))